@@ -1,16 +1,26 @@
 """Hangman API is a two player game where each player will guess each other's word within 10 attempts. Users will start off creating a game via 'new_game' endpoint which will provide the users a 'urlsafe_game_key'. Each game will have a unique 'urlsafe_game_key'. Users will be allowed to create several games indenpendent of other active games. Pass that key to 'make_move' endpoint and take turns guessing a letter trying to identify the correct word identified by the opposite player."""
 
+import collections
 import logging
 import endpoints
 import re
+import time
+import counters
+import dictionary
+import leaderboard
 from google.appengine.ext import ndb
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
 from models import (
     User,
     Game,
     Score,
+    ActiveGame,
+    Move,
+    UserStats,
+    ACTIVE_GAMES_COUNTER,
+    ATTEMPTS_REMAINING_COUNTER,
+    get_user_names,
 )
 from models import (
     StringMessage,
@@ -21,20 +31,71 @@ from models import (
     ScoreForms,
     UserForm,
     UserForms,
+    UserRankForm,
+    UserStatsForm,
+    NewGameForms,
+    MoveRequestForms,
+    BulkGameResultForm,
+    BulkGameResultForms,
+    MoveForms,
+    HintForm,
 )
-from utils import get_by_urlsafe
+from utils import (
+    get_by_urlsafe,
+    get_key_by_urlsafe,
+    fetch_page,
+    fetch_page_async,
+)
+from engine import MAX_WORD_LENGTH, InvalidMove
+from instrumentation import instrumented
 
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
         urlsafe_game_key=messages.StringField(1),)
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    page_size=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3),)
 MAKE_MOVE_REQUEST = endpoints.ResourceContainer(
     MakeMoveForm,
     urlsafe_game_key=messages.StringField(1),)
+HINT_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    user_name=messages.StringField(2),)
+GET_GAME_VERSION_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        since_version=messages.IntegerField(2),)
+WAIT_FOR_TURN_REQUEST = endpoints.ResourceContainer(
+        urlsafe_game_key=messages.StringField(1),
+        user_name=messages.StringField(2),
+        since_version=messages.IntegerField(3),
+        timeout=messages.IntegerField(4, variant=messages.Variant.INT32),)
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
+USER_PAGE_REQUEST = endpoints.ResourceContainer(
+    user_name=messages.StringField(1),
+    page_size=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3),)
+# new_games and make_moves accept at most MAX_BULK_ITEMS items, and
+# make_moves moves MAX_CONCURRENT_MOVES games at a time
+MAX_BULK_ITEMS = 1000
+MAX_CONCURRENT_MOVES = 50
+
+# wait_for_turn holds the request at most this long, well inside the
+# request deadline, and checks memcache this often
+MAX_WAIT_SECONDS = 25
+WAIT_POLL_SECONDS = 0.25
+
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    top_k=messages.IntegerField(1, variant=messages.Variant.INT32),)
+PAGE_REQUEST = endpoints.ResourceContainer(
+    page_size=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2),)
 
-MEMCACHE_MOVES_REMAINING = 'MOVES_REMAINING'
+
+class NotAPlayerException(endpoints.BadRequestException):
+    """Raised by _make_move_async when the user is not in the game"""
 
 
 @endpoints.api(name='hangman', version='v1')
@@ -45,275 +106,656 @@ class HangmanAPI(remote.Service):
                       path='user',
                       name='create_user',
                       http_method='POST')
+    @instrumented
     def create_user(self, request):
         """Create a User. Requires a unique username and an email"""
-        if User.query(User.name == request.user_name).get():
-            raise endpoints.ConflictException(
-                    'User already exists!')
         if request.user_name is None or request.email is None:
             raise endpoints.BadRequestException('Enter a username and email')
-        user = User(name=request.user_name, email=request.email)
-        user.put()
+        if User.get_by_name(request.user_name) or \
+           not User.create(request.user_name, request.email):
+            raise endpoints.ConflictException(
+                    'User already exists!')
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
-    @endpoints.method(response_message=UserForms,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=UserForms,
                       path='user/ranking',
                       name='get_user_rankings',
                       http_method='GET')
+    @instrumented
     def get_user_rankings(self, request):
-        """Return all wins, losses, and games total played."""
+        """Return a page of wins, losses, and games total played."""
         # Players with the most wins will be ranked first.
-        users = User.query().order(-User.game_wins).fetch()
-        return UserForms(items=[user.to_form() for user in users])
+        users, next_cursor = fetch_page(User.query().order(-User.game_wins),
+                                        request.page_size, request.cursor)
+        pending = User.get_pending(users)
+        return UserForms(items=[user.to_form(pending) for user in users],
+                         next_cursor=next_cursor)
+
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=UserForms,
+                      path='leaderboard',
+                      name='get_leaderboard',
+                      http_method='GET')
+    @instrumented
+    def get_leaderboard(self, request):
+        """Return the top_k users by wins from the cached leaderboard, with
+        the results not yet folded into the Users added in"""
+        top_k = min(request.top_k or 10, leaderboard.TOP_K_MAX)
+        top = leaderboard.get_top()[:top_k]
+        pending = User.get_pending_by_key([row[5] for row in top])
+        items = []
+        for name, wins, losses, total, email, key in top:
+            pending_wins, pending_losses = pending[key]
+            items.append(UserForm(
+                name=name, email=email, game_wins=wins + pending_wins,
+                game_losses=losses + pending_losses,
+                total_games_played=total + pending_wins + pending_losses))
+        items.sort(key=lambda form: -form.game_wins)
+        return UserForms(items=items)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserRankForm,
+                      path='user/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    @instrumented
+    def get_user_rank(self, request):
+        """Return a User's rank by wins"""
+        user = User.get_by_name(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException('User not found!')
+        wins = user.current_wins()
+        return UserRankForm(name=user.name, game_wins=wins,
+                            rank=leaderboard.rank(wins))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
                       response_message=GameForm,
                       path='game',
                       name='new_game',
                       http_method='POST')
+    @instrumented
     def new_game(self, request):
         """Creates new game"""
-        player1 = User.query(User.name == request.player1).get()
-        player2 = User.query(User.name == request.player2).get()
+        player1, player2 = ndb.get_multi([User.key_for(request.player1),
+                                          User.key_for(request.player2)])
+        player1 = player1 or User.get_by_name(request.player1)
+        player2 = player2 or User.get_by_name(request.player2)
         if not player1 or not player2:
             raise endpoints.NotFoundException(
                     'One or more of the player name does not exist!')
+        player1_word, player2_word = self._game_words(request)
         try:
-            player1_word = request.player1_word
-            player2_word = request.player2_word
             game = Game.new_game(player1.key, player2.key,
                                  player1_word, player2_word)
-            return game.to_form("Created game successfully")
+            return game.to_form("Created game successfully",
+                                {player1.key: player1.name,
+                                 player2.key: player2.name})
         except:
             raise endpoints.BadRequestException('Failed to initiate new game')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=NewGameForms,
+                      response_message=BulkGameResultForms,
+                      path='games',
+                      name='new_games',
+                      http_method='POST')
+    @instrumented
+    def new_games(self, request):
+        """Creates many games at once. Users are resolved with one get_multi
+        and all valid games are written in one batch. Returns a result per
+        game in request order."""
+        if len(request.items) > MAX_BULK_ITEMS:
+            raise endpoints.BadRequestException(
+                'At most {} games per request'.format(MAX_BULK_ITEMS))
+        users = self._get_users([name for item in request.items
+                                 for name in (item.player1, item.player2)])
+        results = [None] * len(request.items)
+        specs = []
+        indexes = []
+        for index, item in enumerate(request.items):
+            player1 = users.get(item.player1)
+            player2 = users.get(item.player2)
+            if not player1 or not player2:
+                results[index] = BulkGameResultForm(
+                    index=index, success=False,
+                    error='One or more of the player name does not exist!')
+                continue
+            try:
+                player1_word, player2_word = self._game_words(item)
+            except endpoints.BadRequestException as e:
+                results[index] = BulkGameResultForm(index=index,
+                                                    success=False,
+                                                    error=str(e))
+                continue
+            specs.append((player1.key, player2.key,
+                          player1_word, player2_word))
+            indexes.append(index)
+
+        games = Game.new_games(specs)
+        names = dict((user.key, user.name) for user in users.values()
+                     if user)
+        for index, game in zip(indexes, games):
+            results[index] = BulkGameResultForm(
+                index=index, success=True,
+                game=game.to_form("Created game successfully", names))
+        return BulkGameResultForms(items=results)
+
+    @staticmethod
+    def _game_words(form):
+        """Returns the words of a NewGameForm in lower case, picking the
+        missing ones from the dictionary if random_words is set.
+        Raises:
+            endpoints.BadRequestException: If a word is missing, longer than
+                MAX_WORD_LENGTH, has no letter to guess, is not in the
+                dictionary while dictionary.VALIDATE_WORDS is on, or the
+                difficulty is unknown"""
+        words = dictionary.get()
+        if form.difficulty is not None and \
+           form.difficulty not in dictionary.DIFFICULTIES:
+            raise endpoints.BadRequestException(
+                'Difficulty must be one of {}'.format(
+                    ', '.join(dictionary.DIFFICULTIES)))
+        result = []
+        for word in (form.player1_word, form.player2_word):
+            if not word:
+                if not form.random_words:
+                    raise endpoints.BadRequestException(
+                        'Enter both words or set random_words!')
+                word = words.random_word(form.difficulty)
+            elif len(word) > MAX_WORD_LENGTH:
+                raise endpoints.BadRequestException(
+                    'Words can be at most {} characters!'.format(
+                        MAX_WORD_LENGTH))
+            elif not re.search('[a-z]', word.lower()):
+                raise endpoints.BadRequestException(
+                    '{} has no letters to guess!'.format(word))
+            elif dictionary.VALIDATE_WORDS and word.lower() not in words:
+                raise endpoints.BadRequestException(
+                    '{} is not in the dictionary!'.format(word))
+            result.append(word.lower())
+        return result
+
+    @endpoints.method(request_message=GET_GAME_VERSION_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='get_game',
                       http_method='GET')
+    @instrumented
     def get_game(self, request):
-        """Return the current game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if game:
-            return game.to_form("Time to make a move!")
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        """Return the current game state. Served from the cached form when
+        possible, and only the key and version if since_version is still
+        current."""
+        form = self._game_form(request.urlsafe_game_key)
+        if request.since_version is not None and \
+           request.since_version == form.version:
+            return GameForm(urlsafe_key=form.urlsafe_key,
+                            version=form.version,
+                            not_modified=True)
+        return form
+
+    @endpoints.method(request_message=WAIT_FOR_TURN_REQUEST,
+                      response_message=GameForm,
+                      path='game/{urlsafe_game_key}/wait',
+                      name='wait_for_turn',
+                      http_method='GET')
+    @instrumented
+    def wait_for_turn(self, request):
+        """Wait until it is user_name's turn or the game is over, then return
+        the game state, or only not_modified=True if the game is still at
+        since_version. Returns at once when it already is. Polls the small
+        turn entry in memcache and returns not_modified=True with
+        since_version if the turn did not come within the timeout."""
+        urlsafe = request.urlsafe_game_key
+        form = self._game_form(urlsafe)
+        if request.user_name not in (form.player1, form.player2):
+            raise NotAPlayerException('You are not a player in this game!')
+        timeout = min(request.timeout or MAX_WAIT_SECONDS, MAX_WAIT_SECONDS)
+        since_version = request.since_version or 0
+        deadline = time.time() + timeout
+        while True:
+            turn = Game.get_cached_turn(urlsafe)
+            if turn is None:
+                game = Game.get_with_archive(
+                    get_key_by_urlsafe(urlsafe, Game))
+                if not game:
+                    raise endpoints.NotFoundException('Game not found!')
+                game.cache_form()
+                turn = Game.get_cached_turn(urlsafe)
+            if turn is not None:
+                version, next_player, game_over = turn
+                if game_over or next_player == request.user_name:
+                    # The opponent cannot move, there is nothing to wait for
+                    if version == request.since_version:
+                        return GameForm(urlsafe_key=urlsafe, version=version,
+                                        not_modified=True)
+                    return self._game_form(urlsafe)
+            if time.time() + WAIT_POLL_SECONDS > deadline:
+                return GameForm(urlsafe_key=urlsafe, version=since_version,
+                                not_modified=True)
+            time.sleep(WAIT_POLL_SECONDS)
 
     @endpoints.method(request_message=USER_REQUEST,
                       response_message=GameForms,
                       path='user/games',
                       name='get_user_games',
                       http_method='GET')
+    @instrumented
     def get_user_games(self, request):
         """Return a User's active games"""
-        user = User.query(User.name == request.user_name).get()
+        user, game_keys = self._get_user_and_async(
+            request.user_name, ActiveGame.game_keys_async).get_result()
         if not user:
             raise endpoints.BadRequestException('User not found!')
-        games = Game.query(ndb.OR(Game.player1 == user.key,
-                           Game.player2 == user.key)).\
-                           filter(Game.game_over == False)
-        return GameForms(items=[game.to_form("User games retrieved") for game in games])
+        games = [game for game in ndb.get_multi(game_keys)
+                 if game and not game.game_over]
+        return Game.to_forms(games, "User games retrieved")
 
-    @endpoints.method(response_message=GameForms,
+    @staticmethod
+    @ndb.tasklet
+    def _get_user_and_async(user_name, load_async):
+        """Looks a user up by name while load_async(user_key) runs for the
+        key the user is expected to have, so that the two run concurrently.
+        Users still keyed by a numeric id are loaded again with their real
+        key. Returns a future for (user, loaded) or (None, None)."""
+        if not user_name:
+            raise ndb.Return((None, None))
+        user_key = User.key_for(user_name)
+        user, loaded = yield user_key.get_async(), load_async(user_key)
+        if user is None:
+            user = yield User.get_legacy_async(user_name)
+            if user is None:
+                raise ndb.Return((None, None))
+            loaded = yield load_async(user.key)
+        raise ndb.Return((user, loaded))
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=GameForms,
                       path='all_games',
                       name='get_all_games',
                       http_method='GET')
+    @instrumented
     def get_all_games(self, request):
-        """Retrieve all games"""
-        return GameForms(items=[game.to_form("All games \
-                         retrieved") for game in Game.query()])
+        """Retrieve a page of all games"""
+        games, next_cursor = fetch_page(Game.query(), request.page_size,
+                                        request.cursor)
+        return Game.to_forms(games, "All games retrieved", next_cursor)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=StringMessage,
                       path='game/{urlsafe_game_key}',
                       name='cancel_game',
                       http_method='DELETE')
+    @instrumented
     def cancel_game(self, request):
         """Delete a game where game_over is false"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
+        game = self._cancel_game(
+            get_key_by_urlsafe(request.urlsafe_game_key, Game))
         if game and game.game_over is False:
-            game.key.delete()
+            Game.uncache_form(request.urlsafe_game_key)
             return StringMessage(message='Game with key: {} deleted.'.format(request.urlsafe_game_key))
         elif game and game.game_over is True:
             raise endpoints.BadRequestException('Game is already over, cannot delete!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _cancel_game(game_key):
+        """Deletes the game, its ActiveGame entries and its moves in one
+        transaction if it is not over. Returns the game as it was read."""
+        game = game_key.get()
+        if game and game.game_over is False:
+            ndb.delete_multi([game.key] + game.active_game_keys() +
+                             Move.keys_for_game_async(game.key).get_result())
+            game.deactivate()
+        return game
+
     @endpoints.method(request_message=MAKE_MOVE_REQUEST,
                       response_message=GameForm,
                       path='game/{urlsafe_game_key}',
                       name='make_move',
                       http_method='PUT')
+    @instrumented
     def make_move(self, request):
         """Makes a move. Returns a game state with message"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        if not request.user_name:
+            raise endpoints.NotFoundException('User not found')
+        self._validate_guess(request.guess)
+
+        # Users are keyed by name, so the move goes ahead without looking
+        # the user up. The transaction checks that the key is a player of
+        # the game; only then is the user looked up, for users still keyed
+        # by a numeric id and for the error.
+        user_key = User.key_for(request.user_name)
+        try:
+            game = self._make_move_async(game_key, user_key,
+                                         request.guess).get_result()
+        except NotAPlayerException:
+            user = User.get_by_name(request.user_name)
+            if user is None:
+                raise endpoints.NotFoundException('User not found')
+            if user.key == user_key:
+                raise
+            user_key = user.key
+            game = self._make_move_async(game_key, user_key,
+                                         request.guess).get_result()
+
+        names = get_user_names([game.player1, game.player2],
+                               {user_key: request.user_name})
+        game.cache_form(names)
+        return self._move_form(game, names)
+
+    @endpoints.method(request_message=MoveRequestForms,
+                      response_message=BulkGameResultForms,
+                      path='games/moves',
+                      name='make_moves',
+                      http_method='PUT')
+    @instrumented
+    def make_moves(self, request):
+        """Makes many moves at once. Users are resolved with one get_multi
+        and each move runs in its own transaction. The moves on a game run in
+        request order and MAX_CONCURRENT_MOVES games move at a time. Returns
+        a result per move in request order."""
+        if len(request.items) > MAX_BULK_ITEMS:
+            raise endpoints.BadRequestException(
+                'At most {} moves per request'.format(MAX_BULK_ITEMS))
+        users = self._get_users([item.user_name for item in request.items])
+        results = [None] * len(request.items)
+        pending = []
+        for index, item in enumerate(request.items):
+            try:
+                game_key = get_key_by_urlsafe(item.urlsafe_game_key, Game)
+                if users.get(item.user_name) is None:
+                    raise endpoints.NotFoundException('User not found')
+                self._validate_guess(item.guess)
+            except (endpoints.ServiceException, ValueError) as e:
+                results[index] = BulkGameResultForm(index=index,
+                                                    success=False,
+                                                    error=str(e))
+                continue
+            pending.append((index, game_key, users[item.user_name].key,
+                            item.guess))
+
+        # The moves on one game run one after another in request order, as
+        # concurrent transactions on the same game would conflict. Different
+        # games move concurrently, MAX_CONCURRENT_MOVES games at a time.
+        by_game = collections.OrderedDict()
+        for move in pending:
+            by_game.setdefault(move[1], []).append(move)
+        moves = by_game.values()
+        games = {}
+        for start in range(0, len(moves), MAX_CONCURRENT_MOVES):
+            ndb.Future.wait_all([
+                self._make_game_moves_async(game_moves, games, results)
+                for game_moves in moves[start:start + MAX_CONCURRENT_MOVES]])
+
+        names = get_user_names([key for game in games.values()
+                                for key in (game.player1, game.player2)])
+        for index, game in games.items():
+            # Compare-and-set like make_move, a delete could be undone by a
+            # get_game that read the game before the move
+            game.cache_form(names)
+            results[index] = BulkGameResultForm(
+                index=index, success=True,
+                game=self._move_form(game, names))
+        return BulkGameResultForms(items=results)
+
+    @endpoints.method(request_message=HINT_REQUEST,
+                      response_message=HintForm,
+                      path='game/{urlsafe_game_key}/hint',
+                      name='suggest_guess',
+                      http_method='GET')
+    @instrumented
+    def suggest_guess(self, request):
+        """Suggests user_name's next guess, the letter most likely to be in
+        the opponent's word given what has been revealed"""
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
         if not game:
-            raise endpoints.NotFoundException('Game not found')
+            raise endpoints.NotFoundException('Game not found!')
         if game.game_over:
-            raise endpoints.NotFoundException('Game already over')
+            raise endpoints.BadRequestException('Game already over')
+        letter, candidates = game.hint(
+            self._player_index(game, request.user_name))
+        return HintForm(letter=letter, candidates=candidates)
+
+    @classmethod
+    def play_bot_move(cls, game_key, user_key):
+        """Makes the solver's suggested guess for the player user_key, for
+        bot opponents. Returns the updated game."""
+        game = game_key.get()
+        if not game:
+            raise endpoints.NotFoundException('Game not found')
+        if user_key not in (game.player1, game.player2):
+            raise NotAPlayerException('You are not a player in this game!')
+        letter, _ = game.hint(0 if user_key == game.player1 else 1)
+        game = cls._make_move_async(game_key, user_key, letter).get_result()
+        game.cache_form()
+        return game
 
-        # Get user name
-        user = User.query(User.name == request.user_name).get()
-        if user is None:
-            raise endpoints.NotFoundException('User not found')
-        else:
-            if user.key == game.player1:
-                active_player = "player1"
-            else:
-                active_player = "player2"
-        if user.key != game.next_round and \
-           game.attempts_remaining_player1 != 0 and \
-           game.attempts_remaining_player2 != 0:
-            raise endpoints.BadRequestException('Not your turn yet!')
-
-        guess = request.guess
-
-        # Verify how many attempts left
-        if game.attempts_remaining_player1 == 0:
-            raise endpoints.BadRequestException('Player 1 have 0 attempts!')
-        elif game.attempts_remaining_player2 == 0:
-            raise endpoints.BadRequestException('Player 2 have 0 attempts!')
+    @staticmethod
+    def _game_form(urlsafe):
+        """Returns the cached get_game GameForm of a game, loading and
+        caching the game if needed"""
+        form = Game.get_cached_form(urlsafe)
+        if form is None:
+            game = Game.get_with_archive(get_key_by_urlsafe(urlsafe, Game))
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            form = game.cache_form()
+        return form
+
+    @staticmethod
+    def _player_index(game, user_name):
+        """Returns 0 or 1, the player of the game with this name"""
+        names = get_user_names([game.player1, game.player2])
+        if names.get(game.player1) == user_name:
+            return 0
+        if names.get(game.player2) == user_name:
+            return 1
+        raise NotAPlayerException('You are not a player in this game!')
 
+    @staticmethod
+    def _validate_guess(guess):
         validateGuess = re.compile('[a-zA-Z]')
         if not validateGuess.match(guess) or len(guess) > 1:
             raise endpoints.BadRequestException('Enter only 1 character!')
 
-        # Validate if the guess was not guessed before by checking in the list
-        if active_player == "player1":
-            if guess in game.player1_letter_guess:
-                raise endpoints.BadRequestException('You already guessed that letter!')
-            else:
-                game.player1_letter_guess.append(guess)
-                # player guest switches to next player
-                game.next_round = game.player2
-                if game.attempts_remaining_player1 == 1:
-                    game.attempts_remaining_player1 -= 1
-                    game.message = "user was hanged"
-                else:
-                    game.attempts_remaining_player1 -= 1
-
-        if active_player == "player2":
-            if guess in game.player2_letter_guess:
-                raise endpoints.BadRequestException('You already guessed that letter!')
-            else:
-                game.player2_letter_guess.append(guess)
-                game.next_round = game.player1
-                if game.attempts_remaining_player2 == 1:
-                    game.attempts_remaining_player2 -= 1
-                    game.message = "user was hanged"
-                else:
-                    game.attempts_remaining_player2 -= 1
-
-        # Validate if guess exists in the player's word and store in a list
-        if active_player == 'player1':
-            game.check_guess(game.player2_word, guess, game.player1_word_right)
-
-        if active_player == 'player2':
-            game.check_guess(game.player1_word, guess, game.player2_word_right)
-
-        # by default, both are set to False as non-winners
-        player2_pass = False
-        player1_pass = False
-
-        if len(game.player1_word_right) == len(game.player2_word):
-                player1_pass = True
-
-        if len(game.player2_word_right) == len(game.player1_word):
-                player2_pass = True
-
-        if game.attempts_remaining_player1 == 0 and \
-           game.attempts_remaining_player2 == 0:
-            game.key.delete()
-            raise endpoints.NotFoundException('Tie, no winner in this game!')
-
-        if player1_pass:
-            game.end_game(game.player1, game.player2)
-
-        if player2_pass:
-            game.end_game(game.player2, game.player1)
-
-        game.put()
-
-        if game.winner is None:
+    @staticmethod
+    def _move_form(game, names):
+        """Returns the make_move response form of a moved game"""
+        if game.game_over and game.winner is None:
+            game.message = "Tie, no winner in this game!"
+        elif game.winner is None:
             game.message = "No winner at this time. Keep going!"
         else:
             game.message = "User {} wins".format(game.winner)
+        return game.to_form(game.message, names)
 
-        return game.to_form(game.message)
+    @staticmethod
+    def _get_users(user_names):
+        """Returns a dict of name -> User for the names that exist, fetched
+        with one get_multi"""
+        user_names = list(set(name for name in user_names if name))
+        users = ndb.get_multi([User.key_for(name) for name in user_names])
+        result = {}
+        for name, user in zip(user_names, users):
+            result[name] = user or User.get_by_name(name)
+        return result
+
+    @classmethod
+    @ndb.tasklet
+    def _make_game_moves_async(cls, moves, games, results):
+        """Applies the (index, game_key, user_key, guess) moves on one game
+        in order, storing the game after each successful move in games and
+        the error of each failed move in results, by index"""
+        for index, game_key, user_key, guess in moves:
+            # Each move commits on its own, so contention or a datastore
+            # error fails only its own item
+            try:
+                game = yield cls._make_move_async(game_key, user_key, guess)
+            except (endpoints.ServiceException, ValueError,
+                    datastore_errors.Error) as e:
+                results[index] = BulkGameResultForm(index=index,
+                                                    success=False,
+                                                    error=str(e))
+                continue
+            games[index] = game
 
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        taskqueue.add(url='/tasks/send_move',
-                      params={'user_key': game.next_round.urlsafe(),
-                              'game_key': game.key.urlsafe()})
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _make_move_async(game_key, user_key, guess):
+        """Applies one guess as a single cross-group transaction. The game is
+        read and validated inside the transaction and every write (game,
+        move, score and counter shards) goes out in one put_multi_async
+        batch, so a concurrent move makes the commit fail and retry instead
+        of overwriting the guess lists. Returns a future for the updated
+        game, which is over if the move ended it with a win or a tie."""
+        game = yield game_key.get_async()
+        if not game:
+            raise endpoints.NotFoundException('Game not found')
+        if game.game_over:
+            raise endpoints.NotFoundException('Game already over')
+        if user_key not in (game.player1, game.player2):
+            raise NotAPlayerException('You are not a player in this game!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
-                      response_message=StringMessage,
+        player = 0 if user_key == game.player1 else 1
+        engine = game.engine()
+
+        # Deltas that remove the game from the counters if this move ends it
+        end_deltas = game.deactivation_deltas()
+
+        try:
+            correct = engine.guess(player, guess)
+        except InvalidMove as e:
+            raise endpoints.BadRequestException(str(e))
+        game.apply_engine(engine)
+        game.version += 1
+        move = Move(key=ndb.Key(Move, game.version, parent=game.key),
+                    player=user_key,
+                    guess=guess.lower(),
+                    correct=correct,
+                    attempts_remaining=engine.attempts[player])
+        if engine.attempts[player] == 0:
+            game.message = "user was hanged"
+
+        winner = loser = None
+        if engine.winner() is not None:
+            player_keys = (game.player1, game.player2)
+            winner = player_keys[engine.winner()]
+            loser = player_keys[1 - engine.winner()]
+
+        tie = engine.tie()
+
+        entities = [game, move]
+        if winner:
+            score, result_deltas = game.end_game(winner, loser)
+            entities.append(score)
+            end_deltas.update(result_deltas)
+        elif tie:
+            game.end_tie()
+        if tie or winner:
+            shards = counters.update_shards_async(end_deltas)
+        else:
+            shards = counters.update_shards_async(
+                {ATTEMPTS_REMAINING_COUNTER: -1})
+
+        futures = []
+        if game.game_over:
+            futures.extend(ndb.delete_multi_async(game.active_game_keys()))
+        shards = yield shards
+        entities.extend(shards)
+        futures.extend(ndb.put_multi_async(entities))
+        yield futures
+        raise ndb.Return(game)
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
+                      response_message=MoveForms,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
+    @instrumented
     def get_game_history(self, request):
-        """Return a Game's move history"""
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        if not game:
+        """Return a page of a Game's moves in the order they were made"""
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key, Game)
+        moves, next_cursor = fetch_page(Move.query_game(game_key),
+                                        request.page_size, request.cursor)
+        if not moves and not request.cursor and \
+           not Game.get_with_archive(game_key):
             raise endpoints.NotFoundException('Game not found')
-        return StringMessage(message=str("Player1 total moves: " +
-                                         str(game.player1_letter_guess) +
-                                         " Player1 guessed these letters correctly: " +
-                                         str(game.player1_word_right) +
-                                         " Correct word to guess was: " +
-                                         str(game.player2_word) +
-                                         " Player2 total moves: " +
-                                         str(game.player2_letter_guess) +
-                                         " Player2 guessed these letters correctly: " + str(game.player1_word_right) +
-                                         " Correct word to guess was: " +
-                                         str(game.player1_word)))
-        
-
-    @endpoints.method(response_message=ScoreForms,
+        return Move.to_forms(moves, next_cursor)
+
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=ScoreForms,
                       path='scores',
                       name='get_scores',
                       http_method='GET')
+    @instrumented
     def get_scores(self, request):
-        """Return all scores"""
-        return ScoreForms(items=[score.to_form() for score in Score.query()])
+        """Return a page of all scores"""
+        scores, next_cursor = fetch_page(Score.query(), request.page_size,
+                                         request.cursor)
+        return Score.to_forms(scores, next_cursor)
 
-    @endpoints.method(request_message=USER_REQUEST,
+    @endpoints.method(request_message=USER_PAGE_REQUEST,
                       response_message=ScoreForms,
                       path='scores/user/{user_name}',
                       name='get_user_scores',
                       http_method='GET')
+    @instrumented
     def get_user_scores(self, request):
-        """Returns all of an individual User's scores"""
-        user = User.query(User.name == request.user_name).get()
+        """Returns a page of an individual User's wins and losses"""
+        user, page = self._get_user_and_async(
+            request.user_name,
+            lambda user_key: fetch_page_async(Score.query_user(user_key),
+                                              request.page_size,
+                                              request.cursor)).get_result()
+        if not user:
+            raise endpoints.NotFoundException(
+                    'This user does not exist!')
+        scores, next_cursor = page
+        return Score.to_forms(scores, next_cursor)
+
+    @endpoints.method(request_message=USER_REQUEST,
+                      response_message=UserStatsForm,
+                      path='user/{user_name}/stats',
+                      name='get_user_stats',
+                      http_method='GET')
+    @instrumented
+    def get_user_stats(self, request):
+        """Returns a User's wins and losses by opponent, streaks and daily
+        results"""
+        user = User.get_by_name(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'This user does not exist!')
-        scores = Score.query(Score.winner == user.key or
-                             Score.loser == user.key)
-        return ScoreForms(items=[score.to_form() for score in scores])
+        return UserStats.get_form(user)
 
     @endpoints.method(response_message=StringMessage,
                       path='games/average_attempts',
                       name='get_average_attempts_remaining',
                       http_method='GET')
+    @instrumented
     def get_average_attempts(self, request):
-        """Get the cached average moves remaining"""
-        taskqueue.add(url='/tasks/cache_average_attempts')
-        return StringMessage(message=memcache.get(MEMCACHE_MOVES_REMAINING or ''))
+        """Get the average moves remaining from the game counters"""
+        average = Game.average_attempts_remaining()
+        if average is None:
+            return StringMessage(message='There are no active games')
+        return StringMessage(
+            message='The average moves remaining is {:.2f}'.format(average))
 
     @staticmethod
     def _cache_average_attempts():
-        """Populates memcache with the average moves remaining of Games"""
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-            total_attempts_remaining = sum([game.attempts_remaining_player1 +
-                                           game.attempts_remaining_player2
-                                           for game in games])
-            average = float(total_attempts_remaining)/count
-            memcache.set(MEMCACHE_MOVES_REMAINING,
-                         'The average moves remaining is {:.2f}'.format(average))
+        """Reconciles the active game counters with a full scan of the
+        active Games. The counters are maintained incrementally, this only
+        repairs drift, so it runs periodically from cron."""
+        count = 0
+        total_attempts_remaining = 0
+        for game in Game.query(Game.game_over == False):
+            count += 1
+            total_attempts_remaining += game.attempts_remaining()
+        counters.reset(ACTIVE_GAMES_COUNTER, count)
+        counters.reset(ATTEMPTS_REMAINING_COUNTER, total_attempts_remaining)
 
 api = endpoints.api_server([HangmanAPI])
@@ -0,0 +1,756 @@
+#!/usr/bin/env python
+"""benchmark.py - Load generator for the Hangman API on the App Engine
+testbed. Simulates users playing concurrent games through the HangmanAPI
+endpoints and the main.py cron and task handlers against the local
+datastore, memcache, taskqueue and mail stubs, then reports throughput and
+the per-endpoint latency and RPC percentiles collected by instrumentation.py.
+
+    python benchmark.py --sdk_path ~/google-cloud-sdk/platform/google_appengine \\
+        --users 50 --games 200 --save baseline.json
+    python benchmark.py --sdk_path ... --baseline baseline.json
+
+With --baseline the run exits with status 1 if an endpoint makes more RPCs
+or index writes at the median, or is slower than the allowed tolerance, than
+the baseline. Stub latencies are not production latencies, compare runs on
+one machine.
+
+--stress GAMES instead plays GAMES games with concurrent conflicting moves
+and exits with status 1 if an update was lost or applied twice. --listings
+counts the RPCs of each listing rendered with one batched name lookup, as
+the endpoints do, against one get per player of every row. --state_encoding N
+compares the stored size and (de)serialization time of N games in the
+bitmask layout and in the pickled list layout it replaced. --leaderboard
+USERS times the rank and leaderboard lookups over USERS synthetic users."""
+
+import argparse
+import collections
+import json
+import os
+import random
+import string
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+LETTERS = string.ascii_lowercase
+
+
+def setup(sdk_path):
+    """Puts the SDK on sys.path and activates the testbed. Must run before
+    the app modules are imported so that instrumentation.py hooks the stub
+    API proxy."""
+    if sdk_path:
+        sys.path.insert(0, sdk_path)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(app_id='hangman')
+    # Queries see every write, as they do in production after a short delay
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    bed.init_mail_stub()
+    bed.init_app_identity_stub()
+    return bed
+
+
+class Simulation(object):
+    """Drives the API with a seeded random mix of calls"""
+
+    def __init__(self, bed, users, games, seed):
+        import api
+        import main
+        from protorpc import message_types
+        self.api = api
+        self.main = main
+        self.void = message_types.VoidMessage
+        self.service = api.HangmanAPI()
+        self.taskqueue = bed.get_stub('taskqueue')
+        self.random = random.Random(seed)
+        # new_game picks its random words with the module random
+        random.seed(seed)
+        self.user_names = ['user{}'.format(i) for i in range(users)]
+        self.game_count = games
+        self.games = []
+        self.calls = 0
+        self.errors = 0
+
+    def call(self, method, container, **fields):
+        """Calls an endpoint the way the endpoints server would, counting
+        the errors it raises as expected game outcomes"""
+        import endpoints
+        if container is None:
+            request = self.void()
+        elif hasattr(container, 'combined_message_class'):
+            request = container.combined_message_class(**fields)
+        else:
+            request = container(**fields)
+        self.calls += 1
+        try:
+            return getattr(self.service, method)(request)
+        except endpoints.ServiceException:
+            self.errors += 1
+            return None
+
+    def run_handler(self, url, method='GET', body=''):
+        import webapp2
+        request = webapp2.Request.blank(url, POST=body or None)
+        request.method = method
+        if body:
+            request.body = body
+        request.headers['X-AppEngine-Cron'] = 'true'
+        response = request.get_response(self.main.app)
+        self.calls += 1
+        if response.status_int >= 400:
+            self.errors += 1
+
+    def drain_tasks(self):
+        """Runs queued tasks until the queues are empty, including the ones
+        the tasks enqueue"""
+        while True:
+            tasks = []
+            for queue in self.taskqueue.GetQueues():
+                tasks.extend((queue['name'], task) for task in
+                             self.taskqueue.GetTasks(queue['name']))
+            if not tasks:
+                return
+            for queue_name, task in tasks:
+                self.taskqueue.DeleteTask(queue_name, task['name'])
+                self.run_handler(task['url'], task['method'],
+                                 task.get('body', '').decode('base64'))
+
+    def create_users(self):
+        for name in self.user_names:
+            self.call('create_user', self.api.USER_REQUEST, user_name=name,
+                      email='{}@example.com'.format(name))
+
+    def create_games(self):
+        for _ in range(self.game_count):
+            player1, player2 = self.random.sample(self.user_names, 2)
+            form = self.call('new_game', self.api.NEW_GAME_REQUEST,
+                             player1=player1, player2=player2,
+                             random_words=True)
+            if form is not None:
+                # [key, players, opponent words, guessed letters, next player]
+                self.games.append([form.urlsafe_key, (player1, player2),
+                                   (form.player2_word, form.player1_word),
+                                   (set(), set()), 0])
+
+    def guess(self, word, guessed):
+        """Guesses a letter of the word most of the time so games end"""
+        letters = [l for l in set(word) if l not in guessed]
+        if letters and self.random.random() < 0.7:
+            return self.random.choice(letters)
+        return self.random.choice([l for l in LETTERS if l not in guessed])
+
+    def play_round(self):
+        """Makes one move in every game in progress, in random order, with
+        a get_game poll before some of them"""
+        self.random.shuffle(self.games)
+        in_progress = []
+        for game in self.games:
+            key, players, words, guessed, player = game
+            if self.random.random() < 0.3:
+                self.call('get_game', self.api.GET_GAME_VERSION_REQUEST,
+                          urlsafe_game_key=key)
+            letter = self.guess(words[player], guessed[player])
+            guessed[player].add(letter)
+            form = self.call('make_move', self.api.MAKE_MOVE_REQUEST,
+                             urlsafe_game_key=key,
+                             user_name=players[player], guess=letter)
+            game[4] = 1 - player
+            if form is not None and not form.game_over:
+                in_progress.append(game)
+        self.games = in_progress
+
+    def read_listings(self):
+        api = self.api
+        for name in self.random.sample(self.user_names,
+                                       min(10, len(self.user_names))):
+            self.call('get_user_games', api.USER_REQUEST, user_name=name)
+            self.call('get_user_rank', api.USER_REQUEST, user_name=name)
+            self.call('get_user_stats', api.USER_REQUEST, user_name=name)
+            self.call('get_user_scores', api.USER_PAGE_REQUEST,
+                      user_name=name)
+        for game in self.games[:10]:
+            self.call('get_game_history', api.GAME_HISTORY_REQUEST,
+                      urlsafe_game_key=game[0])
+        self.call('get_all_games', api.PAGE_REQUEST)
+        self.call('get_scores', api.PAGE_REQUEST)
+        self.call('get_user_rankings', api.PAGE_REQUEST)
+        self.call('get_leaderboard', api.LEADERBOARD_REQUEST, top_k=10)
+        self.call('get_average_attempts', None)
+
+    def run_crons(self):
+        for url in ('/crons/fold_user_results',
+                    '/tasks/cache_average_attempts',
+                    '/crons/send_reminder',
+                    '/crons/rebuild_leaderboard'):
+            self.run_handler(url)
+        self.drain_tasks()
+
+    def run(self):
+        self.create_users()
+        self.create_games()
+        rounds = 0
+        while self.games:
+            self.play_round()
+            rounds += 1
+            if rounds % 5 == 0:
+                self.read_listings()
+                self.run_crons()
+        self.read_listings()
+        self.run_crons()
+        return rounds
+
+
+class RpcCounter(object):
+    """Counts the RPCs made through the API proxy during measure()"""
+
+    def __init__(self):
+        from google.appengine.api import apiproxy_stub_map
+        self.count = 0
+        self.active = False
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'benchmark', self._hook)
+
+    def _hook(self, service, call, request, response, rpc=None, error=None):
+        if self.active:
+            self.count += 1
+
+    def measure(self, func, *args, **kwargs):
+        """Calls func and returns the number of RPCs it made"""
+        self.count = 0
+        self.active = True
+        try:
+            func(*args, **kwargs)
+        finally:
+            self.active = False
+        return self.count
+
+
+LISTING_PAGE_SIZES = (10, 50, 100)
+
+
+def bench_listings(bed, users, games, seed):
+    """Plays games so that there are Scores, starts new games so that there
+    are active ones, then prints the RPCs of get_all_games, get_scores and
+    get_user_games for a few page sizes. 'per row' renders the same page
+    with a get of each player of every row, as the listings did before the
+    batched name lookup. The ndb caches are off so that both count every
+    lookup."""
+    from google.appengine.ext import ndb
+    import models
+    simulation = Simulation(bed, users, games, seed)
+    simulation.run()
+    simulation.create_games()
+    context = ndb.get_context()
+    context.set_cache_policy(False)
+    context.set_memcache_policy(False)
+    api = simulation.api
+    counter = RpcCounter()
+
+    def names(*keys):
+        return dict((key, key.get().name) for key in keys)
+
+    def games_per_row(page_size):
+        for game in models.Game.query().fetch(page_size):
+            game.to_form('', names(game.player1, game.player2))
+
+    def scores_per_row(page_size):
+        for score in models.Score.query().fetch(page_size):
+            score.to_form(names(score.winner, score.loser))
+
+    user_name = max(simulation.user_names, key=lambda name: len(
+        models.ActiveGame.game_keys_async(
+            models.User.key_for(name)).get_result()))
+
+    def user_games_per_row(page_size):
+        user = models.User.get_by_name(user_name)
+        keys = models.ActiveGame.game_keys_async(user.key).get_result()
+        for game in ndb.get_multi(keys[:page_size]):
+            game.to_form('', names(game.player1, game.player2))
+
+    print('{:<16} {:>5} {:>9} {:>8}'.format('listing', 'page', 'per row',
+                                           'batched'))
+    for page_size in LISTING_PAGE_SIZES:
+        for listing, per_row, batched in (
+                ('get_all_games', games_per_row,
+                 lambda: simulation.call('get_all_games', api.PAGE_REQUEST,
+                                         page_size=page_size)),
+                ('get_scores', scores_per_row,
+                 lambda: simulation.call('get_scores', api.PAGE_REQUEST,
+                                         page_size=page_size)),
+                # lists every active game, page_size only limits the
+                # per row rendering to the same count
+                ('get_user_games', user_games_per_row,
+                 lambda: simulation.call('get_user_games', api.USER_REQUEST,
+                                         user_name=user_name))):
+            print('{:<16} {:>5} {:>9} {:>8}'.format(
+                listing, page_size, counter.measure(per_row, page_size),
+                counter.measure(batched)))
+
+
+def bench_state_encoding(games, seed):
+    """Builds games games part way through in both Game layouts and prints
+    the mean encoded entity size and the time to encode them, and to decode
+    them and read the four guess lists that to_form shows"""
+    from google.appengine.datastore import entity_pb
+    from google.appengine.ext import ndb
+    import dictionary
+    import engine
+    import models
+    rand = random.Random(seed)
+    words = dictionary.get()
+    adapter = ndb.ModelAdapter()
+    layouts = {'pickle': [], 'bitmask': []}
+    for index in range(games):
+        player1_word = words.random_word(rand=rand)
+        player2_word = words.random_word(rand=rand)
+        guesses = [rand.sample(LETTERS, rand.randint(0, 10))
+                   for _ in range(2)]
+        # player1 guesses player2_word and vice versa, the old lists kept
+        # a letter once per position it revealed
+        rights = [[letter for letter in word if letter in guessed]
+                  for guessed, word in zip(guesses,
+                                           (player2_word, player1_word))]
+        game = models.Game.build(ndb.Key('User', 'player1'),
+                                 ndb.Key('User', 'player2'),
+                                 player1_word, player2_word,
+                                 key=ndb.Key(models.Game, index + 1))
+        game.attempts_remaining_player1 -= len(guesses[0])
+        game.attempts_remaining_player2 -= len(guesses[1])
+        game.player1_word_index = game.player2_word_index = []
+        game.legacy_player1_letter_guess = guesses[0]
+        game.legacy_player2_letter_guess = guesses[1]
+        game.legacy_player1_word_right = rights[0]
+        game.legacy_player2_word_right = rights[1]
+        layouts['pickle'].append(game)
+        upgraded = models.Game(key=game.key, **game.to_dict())
+        upgraded.upgrade_legacy_state()
+        layouts['bitmask'].append(upgraded)
+
+    def read_pickle(game):
+        return (game.legacy_player1_letter_guess,
+                game.legacy_player2_letter_guess,
+                game.legacy_player1_word_right,
+                game.legacy_player2_word_right)
+
+    def read_bitmask(game):
+        return (engine.mask_letters(game.player1_guessed),
+                engine.mask_letters(game.player2_guessed),
+                game.player1_word_right, game.player2_word_right)
+
+    print('{:<8} {:>10} {:>11} {:>11}'.format('layout', 'bytes', 'encode us',
+                                             'decode us'))
+    for layout, read in (('pickle', read_pickle), ('bitmask', read_bitmask)):
+        entities = layouts[layout]
+        start = time.time()
+        encoded = [adapter.entity_to_pb(game).Encode() for game in entities]
+        encode_us = (time.time() - start) * 1e6 / len(entities)
+        start = time.time()
+        for data in encoded:
+            read(adapter.pb_to_entity(entity_pb.EntityProto(data)))
+        decode_us = (time.time() - start) * 1e6 / len(entities)
+        print('{:<8} {:>10.1f} {:>11.1f} {:>11.1f}'.format(
+            layout, float(sum(len(data) for data in encoded)) / len(encoded),
+            encode_us, decode_us))
+
+
+def bench_leaderboard(users, lookups, seed):
+    """Stores users Users with long-tailed win counts, rebuilds the
+    leaderboard buckets, then prints the latency and RPC percentiles of
+    get_user_rank for lookups random users and of get_leaderboard, cold
+    (memcache flushed before every call) and warm"""
+    from google.appengine.api import memcache
+    from google.appengine.ext import ndb
+    import api
+    import leaderboard
+    import models
+    rand = random.Random(seed)
+    context = ndb.get_context()
+    context.set_cache_policy(False)
+    context.set_memcache_policy(False)
+    names = ['user{}'.format(index) for index in range(users)]
+    start = time.time()
+    for first in range(0, users, 500):
+        batch = []
+        for name in names[first:first + 500]:
+            wins = int(rand.paretovariate(1.5)) - 1
+            losses = rand.randint(0, 50)
+            batch.append(models.User(
+                key=models.User.key_for(name), name=name,
+                email='{}@example.com'.format(name), game_wins=wins,
+                game_losses=losses, total_games_played=wins + losses))
+        ndb.put_multi(batch)
+    print('stored {} users in {:.1f}s'.format(users, time.time() - start))
+    start = time.time()
+    leaderboard.rebuild()
+    print('rebuilt the buckets in {:.1f}s, top user has {} wins'.format(
+        time.time() - start, leaderboard.get_top()[0][1]))
+
+    service = api.HangmanAPI()
+    counter = RpcCounter()
+    sample = rand.sample(names, min(lookups, users))
+    calls = (('get_user_rank', [api.USER_REQUEST.combined_message_class(
+                  user_name=name) for name in sample]),
+             ('get_leaderboard', [api.LEADERBOARD_REQUEST.
+                                  combined_message_class(top_k=100)] *
+              len(sample)))
+    print('{:<24} {:>9} {:>9} {:>6} {:>6}'.format(
+        'call', 'p50 ms', 'p99 ms', 'rpc50', 'rpc99'))
+    for phase in ('cold', 'warm'):
+        for method, requests in calls:
+            timings = []
+            rpcs = []
+            for request in requests:
+                if phase == 'cold':
+                    memcache.flush_all()
+                start = time.time()
+                rpcs.append(counter.measure(getattr(service, method),
+                                            request))
+                timings.append((time.time() - start) * 1000)
+            timings.sort()
+            rpcs.sort()
+            print('{:<24} {:>9.1f} {:>9.1f} {:>6} {:>6}'.format(
+                '{} {}'.format(method, phase),
+                timings[len(timings) // 2], timings[len(timings) * 99 // 100],
+                rpcs[len(rpcs) // 2], rpcs[len(rpcs) * 99 // 100]))
+
+
+STRESS_ROUNDS = 25
+
+
+def stress_moves(bed, games, seed):
+    """Checks make_move under concurrent play. Each round sends, for every
+    game at once, the guess of the player to move, the same guess again and
+    a guess by the other player as concurrent transactions. Then every game
+    is checked against its Moves, ActiveGame entries and the counters.
+    Returns the problems found."""
+    from google.appengine.api import datastore_errors, memcache
+    from google.appengine.ext import ndb
+    import endpoints
+    import counters
+    import engine
+    import models
+    simulation = Simulation(bed, max(2, games), games, seed)
+    simulation.create_users()
+    simulation.create_games()
+    context = ndb.get_context()
+    context.set_cache_policy(False)
+    context.set_memcache_policy(False)
+    move_async = simulation.api.HangmanAPI._make_move_async
+    rand = simulation.random
+    keys = [ndb.Key(urlsafe=game[0]) for game in simulation.games]
+    commits = dict((key, 0) for key in keys)
+    rejected = collections.Counter()
+    for _ in range(STRESS_ROUNDS):
+        futures = []
+        for key, game in zip(keys, ndb.get_multi(keys)):
+            if game.game_over:
+                continue
+            mover = game.next_round
+            other = game.player2 if mover == game.player1 else game.player1
+            letter = rand.choice(LETTERS)
+            for user_key, guess in ((mover, letter), (mover, letter),
+                                    (other, rand.choice(LETTERS))):
+                futures.append((key, move_async(key, user_key, guess)))
+        if not futures:
+            break
+        for key, future in futures:
+            try:
+                future.get_result()
+                commits[key] += 1
+            except (endpoints.ServiceException,
+                    datastore_errors.Error) as e:
+                rejected[type(e).__name__] += 1
+
+    problems = []
+    active = attempts = 0
+    for key, game in zip(keys, ndb.get_multi(keys)):
+        moves = models.Move.query_game(key).fetch()
+        if not game.version == len(moves) == commits[key]:
+            problems.append('game {}: version {}, {} moves, {} commits'.format(
+                key.id(), game.version, len(moves), commits[key]))
+        for player, guessed, left in (
+                (game.player1, game.player1_guessed,
+                 game.attempts_remaining_player1),
+                (game.player2, game.player2_guessed,
+                 game.attempts_remaining_player2)):
+            made = len([move for move in moves if move.player == player])
+            if not bin(guessed).count('1') == made == \
+                    engine.MAX_ATTEMPTS - left:
+                problems.append('game {}: {} guessed letters, {} moves, {} '
+                                'attempts left'.format(
+                                    key.id(), bin(guessed).count('1'), made,
+                                    left))
+        listed = [entry is not None
+                  for entry in ndb.get_multi(game.active_game_keys())]
+        if listed != [not game.game_over] * 2:
+            problems.append('game {}: game_over {}, ActiveGame {}'.format(
+                key.id(), game.game_over, listed))
+        if not game.game_over:
+            active += 1
+            attempts += game.attempts_remaining()
+    memcache.flush_all()
+    totals = counters.get_counts([models.ACTIVE_GAMES_COUNTER,
+                                  models.ATTEMPTS_REMAINING_COUNTER])
+    if (totals[models.ACTIVE_GAMES_COUNTER],
+            totals[models.ATTEMPTS_REMAINING_COUNTER]) != (active, attempts):
+        problems.append('counters {} != {} active games, {} attempts'.format(
+            totals, active, attempts))
+    print('{} games, {} moves committed, rejected: {}'.format(
+        len(keys), sum(commits.values()),
+        ', '.join('{} {}'.format(count, name)
+                  for name, count in sorted(rejected.items())) or 'none'))
+    return problems
+
+
+def compare(results, baseline, tolerance):
+    """Returns the regressions of results against a saved baseline"""
+    regressions = []
+    for endpoint, stats in sorted(results['endpoints'].items()):
+        base = baseline['endpoints'].get(endpoint)
+        if base is None:
+            continue
+        for field in ('rpcs_p50', 'index_writes_p50'):
+            if stats[field] > base.get(field, stats[field]):
+                regressions.append('{}: {} {} -> {}'.format(
+                    endpoint, field, base[field], stats[field]))
+        if stats['wall_ms_p50'] > base['wall_ms_p50'] * (1 + tolerance):
+            regressions.append('{}: wall_ms_p50 {:.1f} -> {:.1f}'.format(
+                endpoint, base['wall_ms_p50'], stats['wall_ms_p50']))
+    return regressions
+
+
+def report(results):
+    print('{calls} calls ({errors} errors) in {seconds:.1f}s, '
+          '{throughput:.1f} calls/s, {rounds} rounds'.format(**results))
+    header = '{:<40} {:>6} {:>9} {:>9} {:>9} {:>6} {:>6} {:>6}'
+    print(header.format('endpoint', 'calls', 'p50 ms', 'p90 ms', 'p99 ms',
+                        'rpc50', 'rpc99', 'idx50'))
+    for endpoint, stats in sorted(results['endpoints'].items()):
+        print('{:<40} {:>6} {:>9.1f} {:>9.1f} {:>9.1f} {:>6} {:>6} {:>6}'
+              .format(endpoint, stats['calls'], stats['wall_ms_p50'],
+                      stats['wall_ms_p90'], stats['wall_ms_p99'],
+                      stats['rpcs_p50'], stats['rpcs_p99'],
+                      stats['index_writes_p50']))
+
+
+def bench_solver(words_file, iterations, seed):
+    """Times solver.suggest_guess on games in progress over the words of
+    the text file words_file and prints the latency percentiles. Needs only
+    NumPy."""
+    sys.path.insert(0, APP_DIR)
+    import solver
+    start = time.time()
+    with open(words_file) as words:
+        buckets = solver.load(words)
+    print('loaded {} words in {:.0f} ms'.format(
+        sum(len(bucket.masks) for bucket in buckets.values()),
+        (time.time() - start) * 1000))
+    with open(words_file) as words:
+        words = [word.strip() for word in words if word.strip().isalpha()]
+    rand = random.Random(seed)
+    timings = []
+    for _ in range(iterations):
+        word = rand.choice(words).lower()
+        guessed = rand.sample(LETTERS, rand.randint(0, 8))
+        pattern = dict((position, letter)
+                       for position, letter in enumerate(word)
+                       if letter in guessed)
+        mask = sum(1 << (ord(letter) - ord('a')) for letter in guessed)
+        start = time.time()
+        solver.suggest_guess(len(word), pattern, mask)
+        timings.append((time.time() - start) * 1000)
+    timings.sort()
+    print('suggest_guess ms: ' + ' '.join(
+        'p{}={:.3f}'.format(percentile, timings[
+            int(round(percentile / 100.0 * (len(timings) - 1)))])
+        for percentile in (50, 90, 99)))
+
+
+STARTUP_CASES = ('api', 'main', 'api_after_warmup')
+
+
+def startup_child(case):
+    """Runs in a fresh interpreter with the testbed active. Times the
+    import of the case's WSGI app and its first request, and prints them as
+    JSON."""
+    import webob
+    timings = {}
+    if case == 'api_after_warmup':
+        import main
+        start = time.time()
+        webob.Request.blank('/_ah/warmup').get_response(main.app)
+        timings['warmup_ms'] = (time.time() - start) * 1000
+    start = time.time()
+    if case == 'main':
+        import main
+        app = main.app
+        request = webob.Request.blank('/_stats')
+    else:
+        import api
+        app = api.api
+        request = webob.Request.blank(
+            '/_ah/spi/HangmanAPI.get_average_attempts', POST='{}')
+        request.content_type = 'application/json'
+    timings['import_ms'] = (time.time() - start) * 1000
+    start = time.time()
+    response = request.get_response(app)
+    timings['first_request_ms'] = (time.time() - start) * 1000
+    timings['status'] = response.status_int
+    print(json.dumps(timings))
+
+
+def bench_startup(sdk_path, runs):
+    """Times cold starts: each case runs runs times in a new interpreter
+    and the median of each timing is reported"""
+    command = [sys.executable, os.path.abspath(__file__)]
+    if sdk_path:
+        command += ['--sdk_path', sdk_path]
+    for case in STARTUP_CASES:
+        samples = [json.loads(subprocess.check_output(
+            command + ['--startup_child', case]).splitlines()[-1])
+            for _ in range(runs)]
+        medians = dict((field, sorted(sample[field] for sample in samples)[
+            len(samples) // 2]) for field in samples[0])
+        print('{:<18} '.format(case) + ' '.join(
+            '{}={}'.format(field, round(value, 1))
+            for field, value in sorted(medians.items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk_path', default=os.environ.get('APPENGINE_SDK'),
+                        help='App Engine SDK directory (or $APPENGINE_SDK)')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--games', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Compare with a saved run')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed wall time increase over the baseline')
+    parser.add_argument('--solver', type=int, metavar='N',
+                        help='Only time N solver suggestions, for example '
+                        'over a 200k word list given with --words')
+    parser.add_argument('--words', default=os.path.join(APP_DIR, 'words.txt'))
+    parser.add_argument('--startup', type=int, metavar='RUNS',
+                        help='Only time RUNS cold imports and first requests '
+                        'of api.api and main.app, with and without warmup')
+    parser.add_argument('--startup_child', choices=STARTUP_CASES,
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--stress', type=int, metavar='GAMES',
+                        help='Only check GAMES games played with concurrent '
+                        'conflicting moves for lost updates')
+    parser.add_argument('--state_encoding', type=int, metavar='N',
+                        help='Only compare the size and (de)serialization '
+                        'time of N games in the bitmask and pickle layouts')
+    parser.add_argument('--leaderboard', type=int, metavar='USERS',
+                        help='Only time rank and leaderboard lookups over '
+                        'USERS synthetic users, e.g. 100000')
+    parser.add_argument('--lookups', type=int, default=200,
+                        help='Lookups timed by --leaderboard')
+    parser.add_argument('--listings', action='store_true',
+                        help='Only count the RPCs of the listings, batched '
+                        'and per row')
+    args = parser.parse_args()
+
+    if args.startup:
+        bench_startup(args.sdk_path, args.startup)
+        return
+    if args.startup_child:
+        bed = setup(args.sdk_path)
+        try:
+            startup_child(args.startup_child)
+        finally:
+            bed.deactivate()
+        return
+
+    if args.solver:
+        bench_solver(args.words, args.solver, args.seed)
+        return
+
+    if args.state_encoding:
+        bed = setup(args.sdk_path)
+        try:
+            bench_state_encoding(args.state_encoding, args.seed)
+        finally:
+            bed.deactivate()
+        return
+
+    if args.leaderboard:
+        bed = setup(args.sdk_path)
+        try:
+            bench_leaderboard(args.leaderboard, args.lookups, args.seed)
+        finally:
+            bed.deactivate()
+        return
+
+    if args.listings:
+        bed = setup(args.sdk_path)
+        try:
+            bench_listings(bed, args.users, args.games, args.seed)
+        finally:
+            bed.deactivate()
+        return
+
+    if args.stress:
+        bed = setup(args.sdk_path)
+        try:
+            problems = stress_moves(bed, args.stress, args.seed)
+        finally:
+            bed.deactivate()
+        for problem in problems:
+            print('LOST UPDATE ' + problem)
+        if problems:
+            sys.exit(1)
+        return
+
+    bed = setup(args.sdk_path)
+    try:
+        import instrumentation
+        # Keep every call of the run for the percentiles
+        instrumentation.HISTORY_SIZE = None
+        simulation = Simulation(bed, args.users, args.games, args.seed)
+        start = time.time()
+        rounds = simulation.run()
+        seconds = time.time() - start
+        results = {
+            'users': args.users,
+            'games': args.games,
+            'seed': args.seed,
+            'rounds': rounds,
+            'calls': simulation.calls,
+            'errors': simulation.errors,
+            'seconds': seconds,
+            'throughput': simulation.calls / seconds,
+            'endpoints': instrumentation.summary(),
+        }
+    finally:
+        bed.deactivate()
+
+    report(results)
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline),
+                                  args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""counters.py - Sharded counters used to maintain aggregates incrementally.
+Each named counter is spread over NUM_SHARDS entities, or more for counters
+set up with configure(), so that concurrent updates rarely touch the same
+entity group, and the total is kept in memcache so that reads do not have to
+sum the shards."""
+
+import functools
+import itertools
+import random
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 10
+MEMCACHE_PREFIX = 'counter:'
+# A total summed from the shards misses any update that commits before it is
+# added to memcache, so it expires and is summed again after TOTAL_TTL
+TOTAL_TTL = 60
+# counter name -> number of shards, for counters set up with configure()
+_num_shards = {}
+
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(default=0, indexed=False)
+
+
+def configure(name, num_shards):
+    """Spreads a counter that most requests update over num_shards shards
+    instead of NUM_SHARDS. Shards can be added later, never removed."""
+    _num_shards[name] = num_shards
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}-{}'.format(name, index))
+            for index in range(_num_shards.get(name, NUM_SHARDS))]
+
+
+def _update_memcache(name, delta):
+    key = MEMCACHE_PREFIX + name
+    if delta > 0:
+        memcache.incr(key, delta)
+    elif delta < 0:
+        memcache.decr(key, -delta)
+
+
+def get_counts(names):
+    """Returns a dict of counter name -> total. Totals are read from
+    memcache, missing ones are summed from the shards with one get_multi."""
+    cached = memcache.get_multi(names, key_prefix=MEMCACHE_PREFIX)
+    missing = [name for name in names if name not in cached]
+    if missing:
+        keys = dict((name, _shard_keys(name)) for name in missing)
+        shards = iter(ndb.get_multi([key for name in missing
+                                     for key in keys[name]]))
+        totals = {}
+        for name in missing:
+            totals[name] = sum(shard.count
+                               for shard in itertools.islice(
+                                   shards, len(keys[name]))
+                               if shard)
+        memcache.add_multi(totals, key_prefix=MEMCACHE_PREFIX,
+                           time=TOTAL_TTL)
+        cached.update(totals)
+    return cached
+
+
+@ndb.tasklet
+def update_shards_async(deltas):
+    """Fetches a random shard of each counter in deltas (a dict of counter
+    name -> delta) and applies the delta to it. The modified shards are
+    returned for the caller to write in its own batch, and the memcache
+    totals are adjusted once the enclosing transaction commits."""
+    items = deltas.items()
+    keys = [random.choice(_shard_keys(name)) for name, delta in items]
+    shards = yield ndb.get_multi_async(keys)
+    shards = [shard or CounterShard(key=key)
+              for shard, key in zip(shards, keys)]
+    context = ndb.get_context()
+    for shard, (name, delta) in zip(shards, items):
+        shard.count += delta
+        context.call_on_commit(functools.partial(_update_memcache,
+                                                 name, delta))
+    raise ndb.Return(shards)
+
+
+@ndb.transactional(xg=True)
+def increment_multi(deltas):
+    """Applies a dict of counter name -> delta. Joins the enclosing
+    transaction when there is one, so the change commits with the caller's
+    writes."""
+    ndb.put_multi(update_shards_async(deltas).get_result())
+
+
+def increment(name, delta=1):
+    """Adds delta to a single counter"""
+    increment_multi({name: delta})
+
+
+@ndb.transactional(xg=True)
+def transfer(source, target):
+    """Moves the whole total of counter source onto counter target, used
+    when the entity a counter is named after is re-keyed. Returns the total
+    moved."""
+    shards = [shard for shard in ndb.get_multi(_shard_keys(source))
+              if shard and shard.count]
+    total = sum(shard.count for shard in shards)
+    if not total:
+        return 0
+    for shard in shards:
+        shard.count = 0
+    ndb.put_multi(shards + update_shards_async({target: total}).get_result())
+    ndb.get_context().call_on_commit(
+        functools.partial(memcache.delete, MEMCACHE_PREFIX + source))
+    return total
+
+
+def reset(name, value):
+    """Overwrites the counter total with value, used by reconciliation
+    jobs that recompute the aggregate from the source entities. Not
+    transactional, since a configured counter can have more shards than a
+    transaction can write; updates made during the reset may be lost, as
+    they would be with a transaction."""
+    shards = [CounterShard(key=key, count=0) for key in _shard_keys(name)]
+    shards[0].count = value
+    ndb.put_multi(shards)
+    memcache.set(MEMCACHE_PREFIX + name, value)
@@ -0,0 +1,161 @@
+"""dictionary.py - The word dictionary used to validate and pick game words.
+The words are precomputed into a compact binary file (words.dict) that is
+memory-mapped once per instance: a sorted array of words for O(log n)
+lookups and, per difficulty, an array of word indexes for random picks, so
+a request costs a few reads of the mapped file.
+
+Rebuild the file after editing the word list with
+    python dictionary.py words.txt words.dict
+
+File layout, little-endian unsigned 32-bit integers:
+    MAGIC, word count N, then the number of words of each of DIFFICULTIES
+    N + 1 offsets of each word in the word bytes, sorted by word
+    the word indexes of each difficulty, one array after the other
+    the word bytes"""
+
+import math
+import os
+import random
+import struct
+import sys
+import threading
+
+DICTIONARY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               'words.dict')
+# Whether new_game rejects words missing from the dictionary, set in app.yaml
+# env_variables. Only turn it on once words.dict is built from a full word
+# list, the bundled one only has common words.
+VALIDATE_WORDS = os.environ.get('VALIDATE_WORDS', 'false').lower() == 'true'
+MAGIC = 0x444d4e48
+DIFFICULTIES = ('easy', 'medium', 'hard')
+# Relative frequency of each letter in English text, in percent
+LETTER_FREQUENCY = dict(zip(
+    'abcdefghijklmnopqrstuvwxyz',
+    (8.2, 1.5, 2.8, 4.3, 12.7, 2.2, 2.0, 6.1, 7.0, 0.15, 0.77, 4.0, 2.4,
+     6.7, 7.5, 1.9, 0.095, 6.0, 6.3, 9.1, 2.8, 0.98, 2.4, 0.15, 2.0, 0.074)))
+_UINT = struct.Struct('<I')
+
+_lock = threading.Lock()
+_dictionary = None
+
+
+def difficulty_score(word):
+    """Returns how hard a word is to guess: the information (in bits) of its
+    distinct letters, so longer words with more and rarer letters score
+    higher"""
+    return sum(-math.log(LETTER_FREQUENCY[letter] / 100.0, 2)
+               for letter in set(word))
+
+
+class Dictionary(object):
+    """Read-only view of a dictionary file"""
+
+    def __init__(self, data):
+        self.data = data
+        magic, self.size = struct.unpack_from('<II', data, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a dictionary file')
+        levels = len(DIFFICULTIES)
+        self.level_sizes = struct.unpack_from('<{}I'.format(levels), data, 8)
+        self._offsets = 8 + 4 * levels
+        self._levels = []
+        start = self._offsets + 4 * (self.size + 1)
+        for size in self.level_sizes:
+            self._levels.append(start)
+            start += 4 * size
+        self._words = start
+
+    @classmethod
+    def open(cls, path):
+        """Maps the file into memory, or reads it where mmap is not
+        available"""
+        with open(path, 'rb') as source:
+            try:
+                import mmap
+                data = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ImportError, EnvironmentError):
+                data = source.read()
+        return cls(data)
+
+    def _uint(self, position):
+        return _UINT.unpack_from(self.data, position)[0]
+
+    def word(self, index):
+        """Returns the index-th word in sorted order"""
+        position = self._offsets + 4 * index
+        start, end = struct.unpack_from('<II', self.data, position)
+        return self.data[self._words + start:self._words + end]
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, word):
+        """Binary search of the sorted words"""
+        word = word.lower()
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self.word(middle) < word:
+                low = middle + 1
+            else:
+                high = middle
+        return low < self.size and self.word(low) == word
+
+    def __iter__(self):
+        for index in xrange(self.size):
+            yield self.word(index)
+
+    def random_word(self, difficulty=None, rand=random):
+        """Returns a random word of a difficulty in DIFFICULTIES, or of any
+        difficulty if it is None"""
+        if difficulty is None:
+            return self.word(rand.randrange(self.size))
+        level = DIFFICULTIES.index(difficulty)
+        if not self.level_sizes[level]:
+            raise ValueError('No {} words'.format(difficulty))
+        index = rand.randrange(self.level_sizes[level])
+        return self.word(self._uint(self._levels[level] + 4 * index))
+
+
+def get():
+    """Returns the Dictionary of DICTIONARY_FILE, opening it the first time
+    it is needed on this instance"""
+    global _dictionary
+    if _dictionary is None:
+        with _lock:
+            if _dictionary is None:
+                _dictionary = Dictionary.open(DICTIONARY_FILE)
+    return _dictionary
+
+
+def build(words):
+    """Returns the dictionary file contents of an iterable of words. Words
+    that are not plain a-z are left out. Difficulties split the words into
+    equal thirds by difficulty_score."""
+    words = sorted(set(word.strip().lower() for word in words
+                       if word.strip() and
+                       all('a' <= letter <= 'z'
+                           for letter in word.strip().lower())))
+    ranked = sorted(range(len(words)),
+                    key=lambda index: difficulty_score(words[index]))
+    levels = len(DIFFICULTIES)
+    buckets = [sorted(ranked[len(ranked) * level // levels:
+                             len(ranked) * (level + 1) // levels])
+               for level in range(levels)]
+    offsets = [0]
+    for word in words:
+        offsets.append(offsets[-1] + len(word))
+    header = [MAGIC, len(words)] + [len(bucket) for bucket in buckets]
+    integers = header + offsets + [index for bucket in buckets
+                                   for index in bucket]
+    return struct.pack('<{}I'.format(len(integers)), *integers) + \
+        ''.join(words)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python dictionary.py words.txt words.dict')
+    with open(sys.argv[1]) as source:
+        data = build(source)
+    with open(sys.argv[2], 'wb') as output:
+        output.write(data)
@@ -0,0 +1,126 @@
+"""engine.py - Hangman game logic with no datastore dependency. Each word is
+indexed once into 26 position masks (letter -> positions of that letter in
+the word) so that evaluating a guess and detecting a win are a handful of bit
+operations. Game.engine() builds a HangmanEngine from a stored Game and
+make_move delegates every guess to it."""
+
+MAX_ATTEMPTS = 10
+# Position masks are stored in 64-bit signed datastore integers
+MAX_WORD_LENGTH = 63
+_ORD_A = ord('a')
+
+
+class InvalidMove(ValueError):
+    """Raised when a guess breaks the rules of the game"""
+
+
+def letter_bit(letter):
+    """Returns the bit of a letter in a 26-bit guessed-letter mask"""
+    return 1 << (ord(letter.lower()) - _ORD_A)
+
+
+def letters_mask(letters):
+    """Encodes a list of letters as a 26-bit mask"""
+    mask = 0
+    for letter in letters:
+        mask |= letter_bit(letter)
+    return mask
+
+
+def mask_letters(mask):
+    """Decodes a 26-bit mask into its letters in alphabetical order"""
+    return [chr(_ORD_A + i) for i in range(26) if mask >> i & 1]
+
+
+def revealed_letters(word, revealed):
+    """Returns the letters of word at the positions set in revealed"""
+    return [letter for position, letter in enumerate(word)
+            if revealed >> position & 1]
+
+
+def index_word(word):
+    """Returns a list of 26 masks, the positions of each letter in word.
+    Characters that are not letters are left out and never need guessing."""
+    index = [0] * 26
+    for position, letter in enumerate(word.lower()):
+        offset = ord(letter) - _ORD_A
+        if 0 <= offset < 26:
+            index[offset] |= 1 << position
+    return index
+
+
+def solution_mask(index):
+    """Returns the revealed mask of a fully guessed word"""
+    mask = 0
+    for positions in index:
+        mask |= positions
+    return mask
+
+
+class HangmanEngine(object):
+    """State of a two player game. Player 0 guesses the word of player 1 and
+    player 1 guesses the word of player 0.
+
+    Attributes:
+        word_indexes: The index_word() of each player's own word
+        guessed: Letter masks guessed by each player
+        revealed: Position masks each player revealed in the opponent's word
+        attempts: Attempts each player has left
+        next_player: The player whose turn it is"""
+
+    def __init__(self, word_indexes, guessed=(0, 0), revealed=(0, 0),
+                 attempts=(MAX_ATTEMPTS, MAX_ATTEMPTS), next_player=0):
+        self.word_indexes = word_indexes
+        self.solutions = [solution_mask(index) for index in word_indexes]
+        self.guessed = list(guessed)
+        self.revealed = list(revealed)
+        self.attempts = list(attempts)
+        self.next_player = next_player
+
+    @classmethod
+    def new(cls, player1_word, player2_word):
+        """Returns the engine of a game that has not started"""
+        return cls([index_word(player1_word), index_word(player2_word)])
+
+    def guess(self, player, letter):
+        """Applies one guess by player. Returns True if the letter is in the
+        opponent's word. Once a player is out of attempts the other one keeps
+        guessing until they win or run out too.
+        Raises:
+            InvalidMove: If it is not the player's turn, the player has no
+                attempts left, or the letter was already guessed"""
+        if self.attempts[player] == 0:
+            raise InvalidMove('Player {} have 0 attempts!'.format(player + 1))
+        if player != self.next_player and self.attempts[self.next_player]:
+            raise InvalidMove('Not your turn yet!')
+
+        offset = ord(letter.lower()) - _ORD_A
+        if not 0 <= offset < 26:
+            raise InvalidMove('Enter only 1 character!')
+        bit = 1 << offset
+        if self.guessed[player] & bit:
+            raise InvalidMove('You already guessed that letter!')
+
+        self.guessed[player] |= bit
+        self.attempts[player] -= 1
+        if self.attempts[1 - player]:
+            self.next_player = 1 - player
+        positions = self.word_indexes[1 - player][offset]
+        self.revealed[player] |= positions
+        return positions != 0
+
+    def solved(self, player):
+        """True if player has revealed every letter of the opponent's word"""
+        return self.revealed[player] == self.solutions[1 - player]
+
+    def winner(self):
+        """Returns the winning player or None, player 0 is checked first"""
+        if self.solved(0):
+            return 0
+        if self.solved(1):
+            return 1
+        return None
+
+    def tie(self):
+        """True once both players ran out of attempts"""
+        return self.attempts[0] == 0 and self.attempts[1] == 0
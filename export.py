@@ -0,0 +1,157 @@
+"""export.py - Bulk export of Scores and Games for offline analytics, run by
+the admin task /tasks/export instead of paging through the serving
+endpoints. Each task walks one batch of a kind with a cursor and stores it
+as a gzipped newline-delimited JSON ExportShard under the ExportJob. The job
+keeps the cursor of the next batch, so an interrupted export resumes where
+it stopped and a retried task never writes a batch twice."""
+
+import gzip
+import json
+import StringIO
+from google.appengine.api import memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from models import ArchivedGame, Game, Score, get_user_names
+
+BATCH_SIZE = 1000
+NAME_MEMCACHE_PREFIX = 'export_name:'
+NAME_TTL = 3600
+
+
+class ExportJob(ndb.Model):
+    """Progress of the export of one kind"""
+    kind = ndb.StringProperty(required=True, indexed=False)
+    # urlsafe cursor of the next batch
+    cursor = ndb.StringProperty(indexed=False)
+    shards = ndb.IntegerProperty(default=0, indexed=False)
+    rows = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+    def to_dict_summary(self):
+        return {'id': self.key.id(), 'kind': self.kind,
+                'shards': self.shards, 'rows': self.rows, 'done': self.done}
+
+
+class ExportShard(ndb.Model):
+    """One batch of an export, a child of the ExportJob with the shard
+    number, counted from 1, as its id"""
+    data = ndb.BlobProperty()
+    rows = ndb.IntegerProperty(indexed=False)
+
+
+def _names(keys, names):
+    """Resolves User keys to names through memcache, shared by every batch
+    of every export, then the datastore with one get_multi"""
+    missing = [key for key in set(keys) if key and key not in names]
+    cached = memcache.get_multi([key.urlsafe() for key in missing],
+                                key_prefix=NAME_MEMCACHE_PREFIX)
+    for key in missing:
+        if key.urlsafe() in cached:
+            names[key] = cached[key.urlsafe()]
+    resolved = get_user_names(missing, names)
+    memcache.set_multi(dict((key.urlsafe(), resolved[key]) for key in missing
+                            if key.urlsafe() not in cached),
+                       key_prefix=NAME_MEMCACHE_PREFIX, time=NAME_TTL)
+    return names
+
+
+def _score_row(score, names):
+    return {'id': score.key.id(), 'date': str(score.date),
+            'winner': names.get(score.winner),
+            'loser': names.get(score.loser)}
+
+
+def _game_row(game, names):
+    return {'id': game.key.id(),
+            'player1': names.get(game.player1),
+            'player2': names.get(game.player2),
+            'player1_word': game.player1_word,
+            'player2_word': game.player2_word,
+            'player1_letter_guess': game.player1_letter_guess,
+            'player2_letter_guess': game.player2_letter_guess,
+            'player1_word_right': game.player1_word_right,
+            'player2_word_right': game.player2_word_right,
+            'attempts_remaining_player1': game.attempts_remaining_player1,
+            'attempts_remaining_player2': game.attempts_remaining_player2,
+            'game_over': game.game_over,
+            'winner': names.get(game.winner),
+            'moves': game.version,
+            'ended': str(game.ended) if game.ended else None}
+
+
+# kind -> (model, function returning the entities of a batch, user keys of
+# an entity, row builder)
+KINDS = {
+    'Score': (Score, lambda scores: scores,
+              lambda score: (score.winner, score.loser), _score_row),
+    'Game': (Game, lambda games: games,
+             lambda game: (game.player1, game.player2, game.winner),
+             _game_row),
+    'ArchivedGame': (ArchivedGame,
+                     lambda archived: [entity.to_game()
+                                       for entity in archived],
+                     lambda game: (game.player1, game.player2, game.winner),
+                     _game_row),
+}
+
+
+def start(kind):
+    """Creates an ExportJob for a kind in KINDS and enqueues its first
+    batch. Returns the job."""
+    if kind not in KINDS:
+        raise ValueError('Cannot export {}'.format(kind))
+    job = ExportJob(kind=kind)
+    job.put()
+    enqueue(job.key)
+    return job
+
+
+def enqueue(job_key):
+    taskqueue.add(url='/tasks/export', params={'job': job_key.id()})
+
+
+def _encode(rows):
+    output = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=output, mode='wb') as shard:
+        for row in rows:
+            shard.write(json.dumps(row, sort_keys=True))
+            shard.write('\n')
+    return output.getvalue()
+
+
+def run_batch(job_key):
+    """Exports the next batch of a job. Returns True if there are more
+    batches to export."""
+    job = job_key.get()
+    if job is None or job.done:
+        return False
+    model, load, user_keys, build_row = KINDS[job.kind]
+    entities, next_cursor, more = model.query().order(model.key).fetch_page(
+        BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=job.cursor) if job.cursor else None)
+    entities = load(entities)
+    names = _names([key for entity in entities
+                    for key in user_keys(entity)], {})
+    rows = [build_row(entity, names) for entity in entities]
+    shard = job.shards
+    # Integer ids start at 1
+    ExportShard(id=shard + 1, parent=job_key, data=_encode(rows),
+                rows=len(rows)).put()
+
+    @ndb.transactional
+    def advance():
+        # A duplicate task that exported the same batch finds the job moved
+        # on and leaves it alone
+        current = job_key.get()
+        if current.shards != shard:
+            return False
+        current.shards += 1
+        current.rows += len(rows)
+        current.cursor = next_cursor.urlsafe() if next_cursor else None
+        current.done = not (more and next_cursor)
+        current.put()
+        return not current.done
+
+    return advance()
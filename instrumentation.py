@@ -0,0 +1,131 @@
+"""instrumentation.py - Per-request RPC and latency accounting for the
+endpoints in api.py and the handlers in main.py. An apiproxy post-call hook
+counts every RPC the current request makes; the 'instrumented' decorator
+logs one structured line per call and feeds the per-instance histograms
+served by the /_stats admin handler."""
+
+import collections
+import functools
+import json
+import logging
+import os
+import random
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map
+
+# Fraction of requests to run under cProfile, set in app.yaml env_variables
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))
+# Number of recent calls kept per endpoint for the percentiles
+HISTORY_SIZE = 1000
+PERCENTILES = (50, 90, 99)
+
+_local = threading.local()
+_lock = threading.Lock()
+_history = collections.defaultdict(
+    lambda: collections.deque(maxlen=HISTORY_SIZE))
+
+
+def _post_call_hook(service, call, request, response, rpc=None, error=None):
+    stats = getattr(_local, 'stats', None)
+    if stats is None:
+        return
+    stats['rpcs'] += 1
+    stats['rpcs_by_call'][service + '.' + call] += 1
+    if error is not None:
+        return
+    if service == 'datastore_v3':
+        if call in ('Get', 'RunQuery', 'Next'):
+            stats['bytes_read'] += response.ByteSize()
+        elif call in ('Put', 'Delete'):
+            if call == 'Put':
+                stats['bytes_written'] += request.ByteSize()
+            if response.has_cost():
+                stats['entity_writes'] += response.cost().entity_writes()
+                stats['index_writes'] += response.cost().index_writes()
+    elif service == 'memcache' and call == 'Get':
+        hits = response.item_size()
+        stats['memcache_hits'] += hits
+        stats['memcache_misses'] += request.key_size() - hits
+
+
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+    'instrumentation', _post_call_hook)
+
+
+def _percentile(values, percentile):
+    index = int(round(percentile / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def _record(name, stats):
+    with _lock:
+        _history[name].append(stats)
+
+
+def summary():
+    """Returns the percentiles of wall time and RPC counts of the recent
+    calls of each endpoint on this instance"""
+    with _lock:
+        history = dict((name, list(calls))
+                       for name, calls in _history.items())
+    result = {}
+    for name, calls in history.items():
+        entry = {'calls': len(calls)}
+        for field in ('wall_ms', 'rpcs', 'bytes_read', 'bytes_written',
+                      'entity_writes', 'index_writes'):
+            values = sorted(call[field] for call in calls)
+            for percentile in PERCENTILES:
+                entry['{}_p{}'.format(field, percentile)] = \
+                    _percentile(values, percentile)
+        hits = sum(call['memcache_hits'] for call in calls)
+        lookups = hits + sum(call['memcache_misses'] for call in calls)
+        entry['memcache_hit_rate'] = float(hits) / lookups if lookups else None
+        result[name] = entry
+    return result
+
+
+def instrumented(func):
+    """Records wall time, RPC counts, memcache hits and misses and datastore
+    bytes and write ops of each call to func. Nested instrumented calls are counted in the
+    outermost one."""
+    name = func.__name__
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if getattr(_local, 'stats', None) is not None:
+            return func(self, *args, **kwargs)
+        endpoint = '{}.{}'.format(type(self).__name__, name)
+        stats = _local.stats = {
+            'endpoint': endpoint,
+            'rpcs': 0,
+            'rpcs_by_call': collections.Counter(),
+            'memcache_hits': 0,
+            'memcache_misses': 0,
+            'bytes_read': 0,
+            'bytes_written': 0,
+            'entity_writes': 0,
+            'index_writes': 0,
+        }
+        profiler = None
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            import cProfile
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.time()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            stats['wall_ms'] = (time.time() - start) * 1000
+            _local.stats = None
+            if profiler is not None:
+                profiler.disable()
+                import pstats
+                import StringIO
+                output = StringIO.StringIO()
+                pstats.Stats(profiler, stream=output).sort_stats(
+                    'cumulative').print_stats(30)
+                logging.info('profile %s\n%s', endpoint, output.getvalue())
+            logging.info('request_stats %s', json.dumps(stats))
+            _record(endpoint, stats)
+    return wrapper
@@ -0,0 +1,122 @@
+"""leaderboard.py - Rankings by game wins without sorting every User.
+Sharded counters ('buckets') hold how many users have a win count, at LEVELS
+granularities: a level l bucket counts the users whose wins fall in a block
+of BASE ** l win counts. A user's rank is one plus the users above them,
+summed from at most BASE - 1 buckets per level, so it costs the same however
+many wins the top user has. The top TOP_K_MAX users are kept as a snapshot
+in memcache that is rebuilt with one query when it expires or a win changes
+its order."""
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+import counters
+
+TOP_K_MAX = 100
+MEMCACHE_TOP = 'leaderboard:top:2'
+TOP_TTL = 60
+# User.game_wins, referenced by name since models imports this module
+GAME_WINS = ndb.GenericProperty('game_wins')
+BASE = 32
+LEVELS = 4
+
+
+def bucket(wins, level=0):
+    """Returns the counter name of the users whose wins are in the same
+    level block as wins. Level 0 has a bucket per win count."""
+    if level == 0:
+        return 'wins_bucket:{}'.format(wins)
+    return 'wins_bucket_{}:{}'.format(level, wins // BASE ** level)
+
+
+def _move_deltas(old_wins, new_wins):
+    """Counter deltas moving a user from old_wins to new_wins on every level
+    where the two are in different blocks"""
+    deltas = {}
+    for level in range(LEVELS):
+        old, new = bucket(old_wins, level), bucket(new_wins, level)
+        if old != new:
+            deltas[old] = -1
+            deltas[new] = 1
+    return deltas
+
+
+def _invalidate_top():
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete(MEMCACHE_TOP))
+
+
+def record_user():
+    """Counts a new user in the buckets of 0 wins"""
+    counters.increment_multi(dict((bucket(0, level), 1)
+                                  for level in range(LEVELS)))
+
+
+def record_win(user):
+    """Moves a user whose win is about to be added up one bucket, and up
+    the higher levels whose block changes"""
+    counters.increment_multi(_move_deltas(user.game_wins,
+                                          user.game_wins + 1))
+    top = memcache.get(MEMCACHE_TOP)
+    if top is not None and (len(top) < TOP_K_MAX or
+                            user.game_wins + 1 >= top[-1][1]):
+        _invalidate_top()
+
+
+def record_loss(user):
+    """Refreshes the snapshot if it lists the user"""
+    top = memcache.get(MEMCACHE_TOP)
+    if top is not None and any(row[0] == user.name for row in top):
+        _invalidate_top()
+
+
+def get_top():
+    """Returns the snapshot of the top TOP_K_MAX users as a list of
+    (name, game_wins, game_losses, total_games_played, email, key)
+    tuples"""
+    top = memcache.get(MEMCACHE_TOP)
+    if top is None:
+        users = ndb.Query(kind='User').order(-GAME_WINS).fetch(TOP_K_MAX)
+        top = [(user.name, user.game_wins, user.game_losses,
+                user.total_games_played, user.email, user.key)
+               for user in users]
+        memcache.set(MEMCACHE_TOP, top, time=TOP_TTL)
+    return top
+
+
+def rank(wins):
+    """Returns the rank of a user with this many wins, users with equal
+    wins share a rank. On each level, sums the buckets after the one of wins
+    up to the end of their block on the next level, and on the top level up
+    to the highest win count in the snapshot. One memcache get_multi when
+    they are cached."""
+    top = get_top()
+    if not top or wins >= top[0][1]:
+        return 1
+    names = []
+    for level in range(LEVELS):
+        size = BASE ** level
+        first = wins // size + 1
+        last = top[0][1] // size
+        if level < LEVELS - 1:
+            last = min(last, (first - 1) // BASE * BASE + BASE - 1)
+        names.extend(bucket(index * size, level)
+                     for index in range(first, last + 1))
+    return 1 + sum(counters.get_counts(names).values())
+
+
+def rebuild():
+    """Recounts every bucket from the Users, repairing any drift in the
+    incrementally maintained counts"""
+    histogram = {}
+    for wins in ndb.Query(kind='User', projection=[GAME_WINS]).map(
+            lambda user: user.game_wins):
+        histogram[wins] = histogram.get(wins, 0) + 1
+    max_wins = max(histogram) if histogram else 0
+    for level in range(LEVELS):
+        size = BASE ** level
+        totals = {}
+        for wins, count in histogram.items():
+            totals[wins // size] = totals.get(wins // size, 0) + count
+        for index in range(max_wins // size + 1):
+            counters.reset(bucket(index * size, level), totals.get(index, 0))
+    memcache.delete(MEMCACHE_TOP)
@@ -14,52 +14,333 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 #
+import json
+from datetime import datetime
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
-from api import HangmanAPI
-from utils import get_by_urlsafe
+from google.appengine.datastore.datastore_query import Cursor
+import dictionary
+import instrumentation
+import leaderboard
+from instrumentation import instrumented
 
-from models import User, Game
+from models import User, Game, ActiveGame, ArchivedGame, Score, UserStats
 
 
 class SendReminderEmail(webapp2.RequestHandler):
-    def get(self):
-        """Send a reminder email to each User with an email who has
-        games in progress. Body includes a count of active games and their
-        urlsafe keys
-        Called every hour using a cron job"""
-        app_id = app_identity.get_application_id()
-        users = User.query(User.email != None)
+    USERS_PER_TASK = 50
+    # Pages of users handled per request before it enqueues itself
+    PAGES_PER_REQUEST = taskqueue.MAX_TASKS_PER_ADD
 
-        for user in users:
-            games = Game.query(ndb.OR(Game.player1 == user.key,
-                               Game.player2 == user.key)).\
-                               filter(Game.game_over == False)
-            # performs the total count results
-            if games.count() >= 1:
-                subject = 'This is a reminder!'
-                body = 'Hello {}, you have a total of {} games in progress.\
-                        Their' \
-                       ' url safe keys are: {}'.\
-                    format(user.name,
-                           games.count(),
-                           ', '.join(game.key.urlsafe() for game in games))
-                # This will send test emails, the arguments to send_mail are:
-                # from, to, subject, body
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+    @instrumented
+    def post(self):
+        """Fan out reminder emails for every User with games in progress.
+        Pages through the User keys and enqueues a send_reminders task for
+        each page of USERS_PER_TASK users. Handles PAGES_PER_REQUEST pages
+        and enqueues itself with the next cursor.
+        Called every 24 hours using a cron job"""
+        query = User.query()
+        cursor = self.request.get('cursor')
+        cursor = Cursor(urlsafe=cursor) if cursor else None
+        more = True
+        tasks = []
+        while more and len(tasks) < self.PAGES_PER_REQUEST:
+            user_keys, cursor, more = query.fetch_page(
+                self.USERS_PER_TASK, start_cursor=cursor, keys_only=True)
+            more = more and cursor is not None
+            if user_keys:
+                tasks.append(taskqueue.Task(
+                    url='/tasks/send_reminders',
+                    payload=json.dumps([key.urlsafe() for key in user_keys])))
+        if tasks:
+            taskqueue.Queue().add(tasks)
+        if more:
+            taskqueue.add(url='/crons/send_reminder',
+                          params={'cursor': cursor.urlsafe()})
+        self.response.set_status(204)
+
+    get = post
+
+
+class SendReminderBatch(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Send a reminder email to each User in the batch with an email who
+        has games in progress. Body includes a count of active games and
+        their urlsafe keys. The payload is a list of urlsafe User keys, their
+        games are read from the ActiveGame index concurrently."""
+        from google.appengine.api import app_identity, mail
+        app_id = app_identity.get_application_id()
+        user_keys = [ndb.Key(urlsafe=key)
+                     for key in json.loads(self.request.body)]
+        users = ndb.get_multi_async(user_keys)
+        game_keys = [ActiveGame.game_keys_async(key) for key in user_keys]
+        for user, games in zip(users, game_keys):
+            user = user.get_result()
+            games = games.get_result()
+            if user is None or not user.email or not games:
+                continue
+            subject = 'This is a reminder!'
+            body = 'Hello {}, you have a total of {} games in progress.\
+                    Their' \
+                   ' url safe keys are: {}'.\
+                format(user.name,
+                       len(games),
+                       ', '.join(game.urlsafe() for game in games))
+            # This will send test emails, the arguments to send_mail are:
+            # from, to, subject, body
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
 
 
 class UpdateAverageMovesRemaining(webapp2.RequestHandler):
+    @instrumented
     def post(self):
-        """Update game listing announcement in memcache."""
+        """Reconcile the average moves remaining counters.
+        Called every hour using a cron job"""
+        from api import HangmanAPI
         HangmanAPI._cache_average_attempts()
         self.response.set_status(204)
 
+    get = post
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    @instrumented
+    def get(self):
+        """Recount the leaderboard win buckets from the Users.
+        Called every 24 hours using a cron job"""
+        leaderboard.rebuild()
+        self.response.set_status(204)
+
+
+class FoldUserResults(webapp2.RequestHandler):
+    BATCHES_PER_REQUEST = 100
+
+    @instrumented
+    def post(self):
+        """Fold the results of finished games into the players' win and
+        loss counts, UserStats and the leaderboard. Folds up to
+        BATCHES_PER_REQUEST batches and enqueues itself if scores are left.
+        Called every minute using a cron job"""
+        score_keys = Score.query_pending().fetch(
+            Score.FOLD_BATCH_SIZE * self.BATCHES_PER_REQUEST, keys_only=True)
+        for start in range(0, len(score_keys), Score.FOLD_BATCH_SIZE):
+            Score.fold_pending(score_keys[start:start + Score.FOLD_BATCH_SIZE])
+        if len(score_keys) == Score.FOLD_BATCH_SIZE * self.BATCHES_PER_REQUEST:
+            taskqueue.add(url='/crons/fold_user_results')
+        self.response.set_status(204)
+
+    get = post
+
+
+class RebuildUserStats(webapp2.RequestHandler):
+    BATCH_SIZE = 20
+
+    @instrumented
+    def post(self):
+        """Recompute the UserStats rollup of every User from their Scores.
+        Processes one batch and enqueues itself with the next cursor."""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            self.BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for user in users:
+            UserStats.rebuild(user)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/rebuild_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateUserKeys(webapp2.RequestHandler):
+    BATCH_SIZE = 50
+
+    @instrumented
+    def post(self):
+        """Re-key Users stored under numeric ids by their user name.
+        Processes one batch and enqueues itself with the next cursor."""
+        cursor = self.request.get('cursor')
+        users, next_cursor, more = User.query().fetch_page(
+            self.BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        for user in users:
+            if isinstance(user.key.id(), (int, long)):
+                User.migrate_key(user)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_user_keys',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateGameState(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    @instrumented
+    def post(self):
+        """Convert Games stored with pickled guess lists to the bitmask
+        encoding, and stamp finished games that have no end time so that
+        they are archived. Processes one batch and enqueues itself with the
+        next cursor."""
+        cursor = self.request.get('cursor')
+        games, next_cursor, more = Game.query().fetch_page(
+            self.BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        changed = []
+        for game in games:
+            upgraded = game.upgrade_legacy_state()
+            if game.game_over and game.ended is None:
+                game.ended = datetime.now()
+            elif not upgraded:
+                continue
+            changed.append(game)
+        ndb.put_multi(changed)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_game_state',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class IndexActiveGames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    @instrumented
+    def post(self):
+        """Backfill the ActiveGame entries of games created before the
+        index existed, and replace the entries stored as children of the
+        Users. Processes one batch and enqueues itself with the next
+        cursor."""
+        cursor = self.request.get('cursor')
+        games, next_cursor, more = Game.query(
+            Game.game_over == False).fetch_page(
+                self.BATCH_SIZE,
+                start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        ndb.put_multi([entry for game in games
+                       for entry in game.active_games()])
+        ndb.delete_multi([ActiveGame.legacy_key_for(player, game.key)
+                          for game in games
+                          for player in (game.player1, game.player2)])
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/index_active_games',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    BATCH_SIZE = 100
+
+    @instrumented
+    def post(self):
+        """Move games over for Game.ARCHIVE_AFTER_DAYS to ArchivedGame.
+        Processes one batch and enqueues itself with the next cursor.
+        Called every 24 hours using a cron job"""
+        cursor = self.request.get('cursor')
+        games, next_cursor, more = Game.query_archivable().fetch_page(
+            self.BATCH_SIZE,
+            start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+        games = [game for game in games if game.game_over]
+        # The archives are written before the games are deleted, so an
+        # interrupted batch is archived again on the next run
+        ndb.put_multi(ArchivedGame.archive(games))
+        ndb.delete_multi([game.key for game in games])
+        if more and next_cursor:
+            taskqueue.add(url='/crons/archive_games',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+    get = post
+
+
+class StartExport(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Start exporting every entity of a kind (Score, Game or
+        ArchivedGame) for offline analytics and return the ExportJob"""
+        import export
+        try:
+            job = export.start(self.request.get('kind'))
+        except ValueError as error:
+            self.abort(400, str(error))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(job.to_dict_summary()))
+
+
+class ExportData(webapp2.RequestHandler):
+    @instrumented
+    def post(self):
+        """Export the next batch of an ExportJob as one shard and enqueue
+        itself while batches remain. The job keeps its cursor, so calling
+        this again resumes an interrupted export."""
+        import export
+        job_key = ndb.Key(export.ExportJob, int(self.request.get('job')))
+        if export.run_batch(job_key):
+            export.enqueue(job_key)
+        self.response.set_status(204)
+
+    get = post
+
+
+class DownloadExport(webapp2.RequestHandler):
+    def get(self, job_id, shard=None):
+        """Return the progress of an ExportJob, or one of its shards (1 to
+        the job's shard count) as gzipped newline-delimited JSON"""
+        import export
+        job_key = ndb.Key(export.ExportJob, int(job_id))
+        if shard is None:
+            job = job_key.get()
+            if job is None:
+                self.abort(404)
+            self.response.headers['Content-Type'] = 'application/json'
+            self.response.write(json.dumps(job.to_dict_summary()))
+            return
+        entity = export.ExportShard.get_by_id(int(shard), parent=job_key)
+        if entity is None:
+            self.abort(404)
+        self.response.headers['Content-Type'] = 'application/gzip'
+        self.response.headers['Content-Disposition'] = \
+            'attachment; filename={}-{}.json.gz'.format(job_id, shard)
+        self.response.write(entity.data)
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Load the serving path before the instance takes traffic: build
+        the endpoints server, map the word dictionary, build the solver
+        arrays and fill the leaderboard and counter caches"""
+        import api
+        import solver
+        dictionary.get()
+        solver.load()
+        leaderboard.get_top()
+        Game.average_attempts_remaining()
+        self.response.set_status(200)
+
+
+class RequestStats(webapp2.RequestHandler):
+    def get(self):
+        """Return the latency, RPC and memcache percentiles of the recent
+        calls to each endpoint and handler served by this instance"""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(instrumentation.summary(), indent=2))
+
+
 app = webapp2.WSGIApplication([
+    ('/_ah/warmup', Warmup),
+    ('/_stats', RequestStats),
     ('/crons/send_reminder', SendReminderEmail),
+    ('/tasks/send_reminders', SendReminderBatch),
     ('/tasks/cache_average_attempts', UpdateAverageMovesRemaining),
+    ('/crons/rebuild_leaderboard', RebuildLeaderboard),
+    ('/crons/fold_user_results', FoldUserResults),
+    ('/tasks/rebuild_user_stats', RebuildUserStats),
+    ('/tasks/migrate_user_keys', MigrateUserKeys),
+    ('/tasks/migrate_game_state', MigrateGameState),
+    ('/tasks/index_active_games', IndexActiveGames),
+    ('/crons/archive_games', ArchiveGames),
+    ('/exports/start', StartExport),
+    (r'/exports/(\d+)', DownloadExport),
+    (r'/exports/(\d+)/(\d+)', DownloadExport),
+    ('/tasks/export', ExportData),
 ], debug=True)
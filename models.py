@@ -2,103 +2,528 @@
 entities used by the Game. Because these classes are also regular Python
 classes they can include methods (such as 'to_form' and 'new_game')."""
 
+import logging
 import random
-from datetime import date
-from protorpc import messages
+import sys
+from datetime import date, datetime, timedelta
+from protorpc import messages, protojson
+from google.appengine.datastore import entity_pb
+from google.appengine.api import memcache
 from google.appengine.ext import ndb
+import counters
+import leaderboard
+from engine import (
+    HangmanEngine,
+    index_word,
+    letters_mask,
+    mask_letters,
+    revealed_letters,
+)
+
+# Sharded counters aggregating every active game
+ACTIVE_GAMES_COUNTER = 'active_games'
+ATTEMPTS_REMAINING_COUNTER = 'attempts_remaining'
+# Every move updates the attempts remaining counter
+counters.configure(ATTEMPTS_REMAINING_COUNTER, 200)
+
+# Cached get_game responses and turns, see Game.cache_form
+GAME_FORM_MEMCACHE_PREFIX = 'game_form:'
+GAME_TURN_MEMCACHE_PREFIX = 'game_turn:'
+# Cached entries expire, so an entry left stale by a lost write is only
+# served for this long
+GAME_CACHE_TTL = 60
+# Version of the entries uncache_form leaves for a deleted game, newer than
+# any form a racing get_game could still write
+DELETED_VERSION = sys.maxint
+GET_GAME_MESSAGE = "Time to make a move!"
+
+# Per-user sharded counters of the results end_game recorded and
+# Score.fold_pending has not yet folded into the User
+PENDING_WINS_PREFIX = 'pending_wins:'
+PENDING_LOSSES_PREFIX = 'pending_losses:'
+
+
+def _set_if_newer(key, value, time=0):
+    """Stores a (version, ...) tuple in memcache for time seconds unless the
+    cached one has the same or a newer version. Compare-and-set keeps an
+    older version from replacing a newer one when writers race."""
+    client = memcache.Client()
+    for _ in range(3):
+        cached = client.gets(key)
+        if cached is None:
+            if client.add(key, value, time=time):
+                return
+        elif cached[0] >= value[0]:
+            return
+        elif client.cas(key, value, time=time):
+            return
+
+
+@ndb.tasklet
+def get_user_names_async(keys, names=None):
+    """Resolves User keys to user names with a single get_multi.
+
+    Args:
+        keys: An iterable of User keys, duplicates and None are allowed.
+        names: Optional per-request dict of key -> name already resolved.
+            It is updated in place so that later pages reuse it.
+    Returns:
+        A future for the dict of key -> name."""
+    if names is None:
+        names = {}
+    missing = list(set(k for k in keys if k is not None and k not in names))
+    if missing:
+        users = yield ndb.get_multi_async(missing)
+        legacy = []
+        for key, user in zip(missing, users):
+            names[key] = user.name if user else None
+            if user is None and isinstance(key.id(), (int, long)):
+                legacy.append(key)
+        # Keys that could not be repointed when their User was re-keyed by
+        # name (Move.player is unindexed) resolve through its legacy_id
+        if legacy:
+            users = yield [User.query(User.legacy_id == key.id()).get_async()
+                           for key in legacy]
+            for key, user in zip(legacy, users):
+                if user:
+                    names[key] = user.name
+    raise ndb.Return(names)
+
+
+def get_user_names(keys, names=None):
+    """Returns the dict of get_user_names_async"""
+    return get_user_names_async(keys, names).get_result()
+
+
+def _batches(query, size):
+    """Yields the results of a query in lists of at most size entities"""
+    cursor = None
+    more = True
+    while more:
+        entities, cursor, more = query.fetch_page(size, start_cursor=cursor)
+        if entities:
+            yield entities
 
 
 class User(ndb.Model):
-    """User profile"""
+    """User profile. Keyed by the user name so that lookups are strongly
+    consistent gets instead of queries on the name property."""
 
+    # queried by users still keyed by a numeric id
     name = ndb.StringProperty(required=True)
-    email = ndb.StringProperty(required=True)
+    email = ndb.StringProperty(required=True, indexed=False)
+    # ordered on by get_user_rankings and the leaderboard
     game_wins = ndb.IntegerProperty(default=0)
-    game_losses = ndb.IntegerProperty(default=0)
-    total_games_played = ndb.IntegerProperty(default=0)
+    game_losses = ndb.IntegerProperty(default=0, indexed=False)
+    total_games_played = ndb.IntegerProperty(default=0, indexed=False)
+    # numeric id of the entity this user was migrated from, if any
+    legacy_id = ndb.IntegerProperty()
+
+    @classmethod
+    def key_for(cls, name):
+        """Returns the key of the user with this name"""
+        return ndb.Key(cls, name)
+
+    @classmethod
+    def get_by_name(cls, name):
+        """Returns the User with this name or None. Users created before
+        users were keyed by name are found with a query until
+        /tasks/migrate_user_keys has re-keyed them."""
+        return cls.get_by_name_async(name).get_result()
+
+    @classmethod
+    @ndb.tasklet
+    def get_by_name_async(cls, name):
+        """Returns a future for get_by_name"""
+        if not name:
+            raise ndb.Return(None)
+        user = yield cls.key_for(name).get_async()
+        if user is None:
+            user = yield cls.get_legacy_async(name)
+        raise ndb.Return(user)
+
+    @classmethod
+    def get_legacy_async(cls, name):
+        """Returns a future for the User with this name that is still keyed
+        by a numeric id, or None"""
+        return cls.query(cls.name == name).get_async()
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def create(cls, name, email):
+        """Creates a user keyed by name. Returns None if the name is taken,
+        the check and the write happen in one transaction."""
+        key = cls.key_for(name)
+        if key.get():
+            return None
+        user = cls(key=key, name=name, email=email)
+        user.put()
+        leaderboard.record_user()
+        return user
+
+    @classmethod
+    def migrate_key(cls, user):
+        """Re-keys a User stored under a numeric id by its name. Copies its
+        UserStats, repoints every Game and Score that references the old key
+        and moves its pending result counters. Moves keep the old key, which
+        get_user_names resolves through legacy_id. Safe to re-run if
+        interrupted. Returns the migrated user, or None if another user
+        already owns the name."""
+        old_key = user.key
+        new_key = cls.key_for(user.name)
 
-    def to_form(self):
+        @ndb.transactional(xg=True)
+        def copy():
+            existing = new_key.get()
+            if existing:
+                return existing if existing.legacy_id == old_key.id() else None
+            migrated = cls(key=new_key, legacy_id=old_key.id(),
+                           **user.to_dict(exclude=['legacy_id']))
+            entities = [migrated]
+            stats = UserStats.key_for(old_key).get()
+            if stats:
+                entities.append(UserStats(key=UserStats.key_for(new_key),
+                                          **stats.to_dict()))
+            ndb.put_multi(entities)
+            return migrated
+
+        migrated = copy()
+        if migrated is None:
+            logging.warning('Cannot migrate user %s, name %s is taken',
+                            old_key.id(), user.name)
+            return None
+
+        for model, props in ((Game, ('player1', 'player2', 'next_round',
+                                     'winner')),
+                             (Score, ('winner', 'loser'))):
+            for prop in props:
+                query = model.query(getattr(model, prop) == old_key)
+                for entities in _batches(query, 100):
+                    for entity in entities:
+                        setattr(entity, prop, new_key)
+                    ndb.put_multi(entities)
+        old_active = ActiveGame.game_keys_async(old_key).get_result()
+        ndb.put_multi([ActiveGame.build(new_key, game_key)
+                       for game_key in old_active])
+        # After the Scores, so that folding a repointed Score finds its
+        # result in the new counters
+        for old_name, new_name in zip(cls.pending_counters(old_key),
+                                      cls.pending_counters(new_key)):
+            counters.transfer(old_name, new_name)
+        ndb.delete_multi([ActiveGame.key_for(old_key, game_key)
+                          for game_key in old_active] +
+                         [UserStats.key_for(old_key), old_key])
+        return migrated
+
+    @staticmethod
+    def pending_counters(user_key):
+        """Returns the names of the user's pending wins and losses
+        counters"""
+        return (PENDING_WINS_PREFIX + str(user_key.id()),
+                PENDING_LOSSES_PREFIX + str(user_key.id()))
+
+    @classmethod
+    def get_pending(cls, users):
+        """Returns a dict of user key -> (wins, losses) of the results not
+        yet folded into the Users, read from memcache when cached"""
+        return cls.get_pending_by_key([user.key for user in users])
+
+    @classmethod
+    def get_pending_by_key(cls, user_keys):
+        """Returns get_pending() for a list of User keys"""
+        names = dict((key, cls.pending_counters(key)) for key in user_keys)
+        totals = counters.get_counts([name for pair in names.values()
+                                      for name in pair])
+        return dict((key, (totals[wins], totals[losses]))
+                    for key, (wins, losses) in names.items())
+
+    def current_wins(self, pending=None):
+        """Returns game_wins including the wins not yet folded"""
+        if pending is None:
+            pending = User.get_pending([self])
+        return self.game_wins + pending[self.key][0]
+
+    def to_form(self, pending=None):
+        """Returns the UserForm of the user with the results not yet
+        folded added in. Pass get_pending() of a whole page of users to look
+        them up together."""
+        if pending is None:
+            pending = User.get_pending([self])
+        wins, losses = pending[self.key]
         form = UserForm(name=self.name,
                         email=self.email,
-                        game_wins=self.game_wins,
-                        total_games_played=self.total_games_played,
-                        game_losses=self.game_losses)
+                        game_wins=self.game_wins + wins,
+                        total_games_played=self.total_games_played +
+                        wins + losses,
+                        game_losses=self.game_losses + losses)
         return form
 
-    # Increment wins for every winning game
+    # Increment wins for every winning game. The caller writes the entity.
     def add_win(self):
+        leaderboard.record_win(self)
         self.game_wins += 1
         self.total_games_played += 1
-        self.put()
 
-    # Increment losses for every losing game
+    # Increment losses for every losing game. The caller writes the entity.
     def add_loss(self):
+        leaderboard.record_loss(self)
         self.game_losses += 1
         self.total_games_played += 1
-        self.put()
 
 
 class Game(ndb.Model):
     """Game object"""
     player1 = ndb.KeyProperty(required=True, kind='User')
     player2 = ndb.KeyProperty(required=True, kind='User')
+    # Only game_over and the User keys are queried, every other property
+    # is unindexed so that a move does not rewrite index rows
     # first player's word
-    player1_word = ndb.StringProperty(required=True)
+    player1_word = ndb.StringProperty(required=True, indexed=False)
     # second player's word
-    player2_word = ndb.StringProperty(required=True)
-    # PickledProperty to store guessed letters in a list
-    player1_letter_guess = ndb.PickleProperty()
-    # PickledProperty to store guessed letters in a list
-    player2_letter_guess = ndb.PickleProperty()
-    # If guessed letter is correct, store in this list
-    player1_word_right = ndb.PickleProperty()
-    # If guessed letter is correct, store in this list
-    player2_word_right = ndb.PickleProperty()
-    attempts_remaining_player1 = ndb.IntegerProperty()
-    attempts_remaining_player2 = ndb.IntegerProperty()
+    player2_word = ndb.StringProperty(required=True, indexed=False)
+    # 26-bit masks of the letters each player has guessed, bit 0 is 'a'
+    player1_guessed = ndb.IntegerProperty(default=0, indexed=False)
+    player2_guessed = ndb.IntegerProperty(default=0, indexed=False)
+    # Masks of the positions revealed in the opponent's word, bit 0 is the
+    # first letter. player1 guesses player2_word and vice versa.
+    player1_revealed = ndb.IntegerProperty(default=0, indexed=False)
+    player2_revealed = ndb.IntegerProperty(default=0, indexed=False)
+    # index_word() of each word, built once when the game is created
+    player1_word_index = ndb.IntegerProperty(repeated=True, indexed=False)
+    player2_word_index = ndb.IntegerProperty(repeated=True, indexed=False)
+    # Pickled lists used before the bitmask encoding. Decoded by
+    # upgrade_legacy_state and cleared by /tasks/migrate_game_state.
+    legacy_player1_letter_guess = ndb.PickleProperty('player1_letter_guess')
+    legacy_player2_letter_guess = ndb.PickleProperty('player2_letter_guess')
+    legacy_player1_word_right = ndb.PickleProperty('player1_word_right')
+    legacy_player2_word_right = ndb.PickleProperty('player2_word_right')
+    attempts_remaining_player1 = ndb.IntegerProperty(indexed=False)
+    attempts_remaining_player2 = ndb.IntegerProperty(indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     winner = ndb.KeyProperty(kind='User')
-    message = ndb.StringProperty()
+    message = ndb.StringProperty(indexed=False)
     # determines who is next to play
     next_round = ndb.KeyProperty(kind='User')
+    # incremented by every move, tags the cached GameForm
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # when the game was won or tied, games over for ARCHIVE_AFTER_DAYS are
+    # moved to ArchivedGame by /crons/archive_games
+    ended = ndb.DateTimeProperty()
+
+    ARCHIVE_AFTER_DAYS = 30
 
     @classmethod
+    def get_with_archive(cls, key):
+        """Returns the game with this key, restored from its ArchivedGame if
+        it has been archived, or None"""
+        game = key.get()
+        if game is None:
+            game = ArchivedGame.restore(key)
+        return game
+
+    @classmethod
+    def query_archivable(cls):
+        """Returns a query of the games over for at least
+        ARCHIVE_AFTER_DAYS"""
+        cutoff = datetime.now() - timedelta(days=cls.ARCHIVE_AFTER_DAYS)
+        # Games in progress store ended as null, which sorts before every
+        # datetime, so the query needs a lower bound too
+        return cls.query(cls.ended > datetime(1970, 1, 1), cls.ended < cutoff)
+
+    @classmethod
+    @ndb.transactional(xg=True)
     def new_game(cls, player1, player2, player1_word, player2_word):
         """Creates and returns a new game"""
-        game = Game(player1=player1,
-                    player2=player2,
-                    player1_word=player1_word,
-                    player2_word=player2_word,
-                    player1_letter_guess=[],
-                    player2_letter_guess=[],
-                    player1_word_right=[],
-                    player2_word_right=[],
-                    attempts_remaining_player1=10,
-                    attempts_remaining_player2=10,
-                    next_round=player1)
+        game = cls.build(player1, player2, player1_word, player2_word)
         game.put()
+        ndb.put_multi(game.active_games())
+        counters.increment_multi({
+            ACTIVE_GAMES_COUNTER: 1,
+            ATTEMPTS_REMAINING_COUNTER: game.attempts_remaining()})
         return game
 
-    def check_guess(self, right_word, guess, word_right):
-        """Count repeated letters in the word and compare."""
-        if guess in list(right_word):
-            right_word_dict = {}
-            for i in set(right_word):
-                x = right_word.count(i, 0, len(right_word))
-                right_word_dict[i] = x
-            for key in right_word_dict:
-                if key == guess:
-                    t = right_word_dict[key]
-            for m in range(0, t):
-                word_right.append(guess)
-
-    def to_form(self, message):
-        """Returns a GameForm representation of the Game"""
+    @classmethod
+    def build(cls, player1, player2, player1_word, player2_word, key=None):
+        """Returns a new, unsaved game"""
+        return cls(key=key,
+                   player1=player1,
+                   player2=player2,
+                   player1_word=player1_word,
+                   player2_word=player2_word,
+                   player1_word_index=index_word(player1_word),
+                   player2_word_index=index_word(player2_word),
+                   attempts_remaining_player1=10,
+                   attempts_remaining_player2=10,
+                   next_round=player1)
+
+    @classmethod
+    def new_games(cls, specs):
+        """Creates many games at once from a list of (player1, player2,
+        player1_word, player2_word) tuples. Ids are allocated up front so
+        games and their ActiveGame entries go out in one put_multi, and the
+        counters are updated once for the whole batch. Returns the games."""
+        if not specs:
+            return []
+        start, end = cls.allocate_ids(size=len(specs))
+        games = [cls.build(*spec, key=ndb.Key(cls, game_id))
+                 for spec, game_id in zip(specs, range(start, end + 1))]
+        entities = list(games)
+        for game in games:
+            entities.extend(game.active_games())
+        ndb.put_multi(entities)
+        counters.increment_multi({
+            ACTIVE_GAMES_COUNTER: len(games),
+            ATTEMPTS_REMAINING_COUNTER: sum(game.attempts_remaining()
+                                            for game in games)})
+        return games
+
+    def active_games(self):
+        """The ActiveGame entries listing this game for each player. Written
+        with the game and deleted once it is over."""
+        return [ActiveGame.build(self.player1, self.key),
+                ActiveGame.build(self.player2, self.key)]
+
+    def active_game_keys(self):
+        """Keys of the active_games() entries"""
+        return [ActiveGame.key_for(self.player1, self.key),
+                ActiveGame.key_for(self.player2, self.key)]
+
+    def attempts_remaining(self):
+        """Total attempts both players have left"""
+        return self.attempts_remaining_player1 + \
+            self.attempts_remaining_player2
+
+    def deactivation_deltas(self):
+        """Counter deltas that remove this game from the active game
+        aggregates. Applied once when the game ends, is cancelled or is
+        tied."""
+        return {ACTIVE_GAMES_COUNTER: -1,
+                ATTEMPTS_REMAINING_COUNTER: -self.attempts_remaining()}
+
+    def deactivate(self):
+        """Removes this game from the active game aggregates"""
+        counters.increment_multi(self.deactivation_deltas())
+
+    @staticmethod
+    def average_attempts_remaining():
+        """Returns the average attempts remaining over all active games, or
+        None if there are none. Served from the sharded counters."""
+        totals = counters.get_counts([ACTIVE_GAMES_COUNTER,
+                                      ATTEMPTS_REMAINING_COUNTER])
+        if totals[ACTIVE_GAMES_COUNTER] <= 0:
+            return None
+        return float(totals[ATTEMPTS_REMAINING_COUNTER]) / \
+            totals[ACTIVE_GAMES_COUNTER]
+
+    def word_indexes(self):
+        """Returns the position index of both words, building it for games
+        created before it was stored"""
+        if not self.player1_word_index:
+            self.player1_word_index = index_word(self.player1_word)
+        if not self.player2_word_index:
+            self.player2_word_index = index_word(self.player2_word)
+        return [self.player1_word_index, self.player2_word_index]
+
+    def check_guess(self, word_index, guess, revealed):
+        """Returns the revealed position mask with every position of the
+        guessed letter set, looked up in the word's index."""
+        return revealed | word_index[ord(guess.lower()) - ord('a')]
+
+    def hint(self, player):
+        """Returns (letter, candidate words) of the solver's next guess for
+        player (0 or 1) from what that player can see of the opponent's
+        word"""
+        self.upgrade_legacy_state()
+        word = (self.player2_word, self.player1_word)[player].lower()
+        revealed = (self.player1_revealed, self.player2_revealed)[player]
+        guessed = (self.player1_guessed, self.player2_guessed)[player]
+        # Imported here since it loads NumPy, which only hints need
+        import solver
+        # Characters that are not letters are never guessed and show as is
+        pattern = dict((position, letter)
+                       for position, letter in enumerate(word)
+                       if revealed >> position & 1 or
+                       not 'a' <= letter <= 'z')
+        return solver.suggest_guess(len(word), pattern, guessed)
+
+    def engine(self):
+        """Returns a HangmanEngine holding the state of this game"""
+        self.upgrade_legacy_state()
+        return HangmanEngine(
+            self.word_indexes(),
+            guessed=(self.player1_guessed, self.player2_guessed),
+            revealed=(self.player1_revealed, self.player2_revealed),
+            attempts=(self.attempts_remaining_player1,
+                      self.attempts_remaining_player2),
+            next_player=0 if self.next_round == self.player1 else 1)
+
+    def apply_engine(self, engine):
+        """Copies the state of a HangmanEngine back onto this game"""
+        self.player1_guessed, self.player2_guessed = engine.guessed
+        self.player1_revealed, self.player2_revealed = engine.revealed
+        self.attempts_remaining_player1, self.attempts_remaining_player2 = \
+            engine.attempts
+        self.next_round = (self.player1, self.player2)[engine.next_player]
+
+    def upgrade_legacy_state(self):
+        """Converts the pickled guess lists of games created before the
+        bitmask encoding. Returns True if the game changed and needs to be
+        written."""
+        legacy = (self.legacy_player1_letter_guess,
+                  self.legacy_player2_letter_guess,
+                  self.legacy_player1_word_right,
+                  self.legacy_player2_word_right)
+        if all(value is None for value in legacy):
+            return False
+        p1_guess, p2_guess, p1_right, p2_right = [value or []
+                                                  for value in legacy]
+        self.player1_guessed = letters_mask(p1_guess)
+        self.player2_guessed = letters_mask(p2_guess)
+        player1_index, player2_index = self.word_indexes()
+        self.player1_revealed = 0
+        for letter in set(p1_right):
+            self.player1_revealed = self.check_guess(
+                player2_index, letter, self.player1_revealed)
+        self.player2_revealed = 0
+        for letter in set(p2_right):
+            self.player2_revealed = self.check_guess(
+                player1_index, letter, self.player2_revealed)
+        self.legacy_player1_letter_guess = None
+        self.legacy_player2_letter_guess = None
+        self.legacy_player1_word_right = None
+        self.legacy_player2_word_right = None
+        return True
+
+    # List views decoded from the masks, as exposed by to_form and history
+    @property
+    def player1_letter_guess(self):
+        self.upgrade_legacy_state()
+        return mask_letters(self.player1_guessed)
+
+    @property
+    def player2_letter_guess(self):
+        self.upgrade_legacy_state()
+        return mask_letters(self.player2_guessed)
+
+    @property
+    def player1_word_right(self):
+        self.upgrade_legacy_state()
+        return revealed_letters(self.player2_word, self.player1_revealed)
+
+    @property
+    def player2_word_right(self):
+        self.upgrade_legacy_state()
+        return revealed_letters(self.player1_word, self.player2_revealed)
+
+    def to_form(self, message, names=None):
+        """Returns a GameForm representation of the Game. Player names are
+        looked up in 'names' and resolved with one get_multi if missing."""
+        names = get_user_names([self.player1, self.player2], names)
         form = GameForm(urlsafe_key=self.key.urlsafe(),
                         player1_word=str(self.player1_word),
                         player2_word=str(self.player2_word),
-                        player1=str(self.player1.get().name),
-                        player2=str(self.player2.get().name),
+                        player1=str(names[self.player1]),
+                        player2=str(names[self.player2]),
                         player1_letter_guess=str(self.player1_letter_guess),
                         player2_letter_guess=str(self.player2_letter_guess),
                         attempts_remaining_player1=int(self.attempts_remaining_player1),
@@ -106,66 +531,450 @@ class Game(ndb.Model):
                         player1_word_right=str(self.player1_word_right),
                         player2_word_right=str(self.player2_word_right),
                         game_over=self.game_over,
-                        message=message
+                        message=message,
+                        version=self.version
                         )
 
         return form
 
+    @staticmethod
+    def _form_cache_key(urlsafe):
+        return GAME_FORM_MEMCACHE_PREFIX + urlsafe
+
+    @classmethod
+    def get_cached_form(cls, urlsafe):
+        """Returns the cached get_game GameForm of a game or None"""
+        cached = memcache.get(cls._form_cache_key(urlsafe))
+        if cached is None or cached[0] == DELETED_VERSION:
+            return None
+        return protojson.decode_message(GameForm, cached[1])
+
+    @staticmethod
+    def _turn_cache_key(urlsafe):
+        return GAME_TURN_MEMCACHE_PREFIX + urlsafe
+
+    @classmethod
+    def get_cached_turn(cls, urlsafe):
+        """Returns the cached (version, next player name, game_over) of a
+        game or None. Small enough to poll, see wait_for_turn."""
+        turn = memcache.get(cls._turn_cache_key(urlsafe))
+        if turn is None or turn[0] == DELETED_VERSION:
+            return None
+        return turn
+
+    def cache_form(self, names=None):
+        """Caches the get_game GameForm of this game, keyed by the game and
+        tagged with its version, along with the tiny turn entry polled by
+        wait_for_turn. Both expire after GAME_CACHE_TTL. Returns the cached
+        form."""
+        names = get_user_names([self.player1, self.player2], names)
+        urlsafe = self.key.urlsafe()
+        form = self.to_form(GET_GAME_MESSAGE, names)
+        _set_if_newer(self._form_cache_key(urlsafe),
+                      (self.version, protojson.encode_message(form)),
+                      GAME_CACHE_TTL)
+        _set_if_newer(self._turn_cache_key(urlsafe),
+                      (self.version, names.get(self.next_round),
+                       self.game_over), GAME_CACHE_TTL)
+        return form
+
+    @classmethod
+    def uncache_form(cls, urlsafe):
+        """Replaces the cached entries of a deleted game with DELETED_VERSION
+        markers, so that a get_game that read the game before it was deleted
+        cannot cache it again"""
+        memcache.set_multi({cls._form_cache_key(urlsafe):
+                            (DELETED_VERSION, None),
+                            cls._turn_cache_key(urlsafe):
+                            (DELETED_VERSION, None, True)},
+                           time=GAME_CACHE_TTL)
+
+    @classmethod
+    def to_forms(cls, games, message, next_cursor=None):
+        """Returns GameForms for a list of games, resolving every player
+        name with a single batch lookup"""
+        names = get_user_names([k for g in games
+                                for k in (g.player1, g.player2)])
+        return GameForms(items=[game.to_form(message, names)
+                                for game in games],
+                         next_cursor=next_cursor)
+
     def end_game(self, winner, loser):
-        """Ends the game"""
+        """Ends the game. Takes the winning and losing User keys and returns
+        the new Score and the counter deltas recording the result for the
+        caller to write along with the game. The Users and their UserStats
+        are not written here, Score.fold_pending folds the result into them
+        later so that players finishing many games do not contend on their
+        entity groups. The caller also deletes active_game_keys()."""
         self.winner = winner
         self.game_over = True
-        self.put()
-        loser = loser
-        score = Score(date=date.today(), winner=winner, loser=loser)
-        score.put()
+        self.ended = datetime.now()
+        score = Score(date=date.today(), winner=winner, loser=loser,
+                      pending=True)
+        deltas = {User.pending_counters(winner)[0]: 1,
+                  User.pending_counters(loser)[1]: 1}
+        return score, deltas
+
+
+    def end_tie(self):
+        """Ends the game without a winner once both players are out of
+        attempts. The caller deletes active_game_keys()."""
+        self.game_over = True
+        self.ended = datetime.now()
+
 
-        # Update the user model
-        winner.get().add_win()
-        loser.get().add_loss()
+class ArchivedGame(ndb.Model):
+    """Final state of a Game that has been over for ARCHIVE_AFTER_DAYS,
+    with the Game id as its id. The Game entity is stored as one compressed
+    unindexed blob, so archived games add nothing to the Game queries and
+    indexes. Its Move children stay under the original Game key."""
+    state = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def archive(cls, games):
+        """Returns the ArchivedGame entities of a list of games"""
+        return [cls(id=game.key.id(),
+                    state=ndb.ModelAdapter().entity_to_pb(game).Encode())
+                for game in games]
+
+    @classmethod
+    def restore(cls, game_key):
+        """Returns the archived Game with this key, or None"""
+        archived = cls.get_by_id(game_key.id())
+        if archived is None:
+            return None
+        return archived.to_game()
+
+    def to_game(self):
+        """Returns the archived Game"""
+        return ndb.ModelAdapter().pb_to_entity(
+            entity_pb.EntityProto(self.state))
+
+
+class ActiveGame(ndb.Model):
+    """Lists a game in progress for one of its players. A root entity keyed
+    '<user id>|<game id>', so that starting and ending games does not write
+    to the players' entity groups. A player's active games are a keys-only
+    query on user followed by one get_multi."""
+    user = ndb.KeyProperty(required=True, kind='User')
+
+    @classmethod
+    def key_for(cls, user_key, game_key):
+        return ndb.Key(cls, '{}|{}'.format(user_key.id(), game_key.id()))
+
+    @classmethod
+    def build(cls, user_key, game_key):
+        return cls(key=cls.key_for(user_key, game_key), user=user_key)
+
+    @staticmethod
+    def legacy_key_for(user_key, game_key):
+        """Key of the entry as it was stored before, a child of the User"""
+        return ndb.Key('ActiveGame', game_key.id(), parent=user_key)
+
+    @classmethod
+    @ndb.tasklet
+    def game_keys_async(cls, user_key):
+        """Returns a future for the keys of the user's active games. The
+        query is eventually consistent, a game started a moment ago may be
+        missing and one that just ended may still be listed."""
+        keys = yield cls.query(cls.user == user_key).fetch_async(
+            keys_only=True)
+        raise ndb.Return([ndb.Key(Game, int(key.id().rsplit('|', 1)[1]))
+                          for key in keys])
+
+
+class Move(ndb.Model):
+    """One guess of a game, a child of the Game with the game version after
+    the guess as its id. Written in the same batch as the game update, so a
+    game's history is an ancestor query ordered by key."""
+    player = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    guess = ndb.StringProperty(required=True, indexed=False)
+    correct = ndb.BooleanProperty(required=True, indexed=False)
+    attempts_remaining = ndb.IntegerProperty(indexed=False)
+    date = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def query_game(cls, game_key):
+        """Returns a query of the game's moves in the order they were made"""
+        return cls.query(ancestor=game_key).order(cls.key)
+
+    @classmethod
+    def keys_for_game_async(cls, game_key):
+        """Returns a future for the keys of every move of the game"""
+        return cls.query(ancestor=game_key).fetch_async(keys_only=True)
+
+    def to_form(self, names=None):
+        names = get_user_names([self.player], names)
+        return MoveForm(move=self.key.id(),
+                        player=names[self.player],
+                        guess=self.guess,
+                        correct=self.correct,
+                        attempts_remaining=self.attempts_remaining,
+                        date=str(self.date))
+
+    @classmethod
+    def to_forms(cls, moves, next_cursor=None):
+        """Returns MoveForms for a list of moves, resolving every player
+        name with a single batch lookup"""
+        names = get_user_names([move.player for move in moves])
+        return MoveForms(items=[move.to_form(names) for move in moves],
+                         next_cursor=next_cursor)
 
 
 class Score(ndb.Model):
     """Score object"""
-    date = ndb.DateProperty(required=True)
+    date = ndb.DateProperty(required=True, indexed=False)
     winner = ndb.KeyProperty(required=True)
     loser = ndb.KeyProperty(required=True)
+    # True until fold_pending has added the result to both Users
+    pending = ndb.BooleanProperty(default=False)
+
+    # Scores folded per transaction. Each one touches its two users and
+    # two pending counter shards, and a win moves up to two leaderboard
+    # bucket shards per level, which keeps a batch within the 25 entity
+    # group limit.
+    FOLD_BATCH_SIZE = 2
 
-    def to_form(self):
+    def to_form(self, names=None):
+        names = get_user_names([self.winner, self.loser], names)
         return ScoreForm(date=str(self.date),
-                         winner=self.winner.get().name,
-                         loser=self.loser.get().name)
+                         winner=names[self.winner],
+                         loser=names[self.loser])
+
+    @classmethod
+    def to_forms(cls, scores, next_cursor=None):
+        """Returns ScoreForms for a list of scores, resolving every player
+        name with a single batch lookup"""
+        names = get_user_names([k for s in scores
+                                for k in (s.winner, s.loser)])
+        return ScoreForms(items=[score.to_form(names) for score in scores],
+                          next_cursor=next_cursor)
+
+    @classmethod
+    def query_pending(cls):
+        """Returns a query of the scores not yet folded into the Users"""
+        return cls.query(cls.pending == True)
+
+    @classmethod
+    @ndb.transactional(xg=True)
+    def fold_pending(cls, score_keys):
+        """Folds at most FOLD_BATCH_SIZE pending scores into the game counts
+        of their Users, their UserStats and the leaderboard, and moves the
+        results out of the pending counters in the same transaction so that
+        reads never count a result twice. Scores that are already folded
+        are skipped, so a retried batch is harmless."""
+        scores = [score for score in ndb.get_multi(score_keys)
+                  if score and score.pending]
+        if not scores:
+            return 0
+        user_keys = list(set(key for score in scores
+                             for key in (score.winner, score.loser)))
+        entities = ndb.get_multi(user_keys +
+                                 [UserStats.key_for(key) for key in user_keys])
+        users = dict(zip(user_keys, entities[:len(user_keys)]))
+        stats = dict((key, stats or UserStats(key=UserStats.key_for(key)))
+                     for key, stats in zip(user_keys,
+                                           entities[len(user_keys):]))
+        deltas = {}
+        for score in sorted(scores, key=lambda score: score.key.id()):
+            score.pending = False
+            winner = users[score.winner]
+            loser = users[score.loser]
+            wins_counter = User.pending_counters(score.winner)[0]
+            losses_counter = User.pending_counters(score.loser)[1]
+            deltas[wins_counter] = deltas.get(wins_counter, 0) - 1
+            deltas[losses_counter] = deltas.get(losses_counter, 0) - 1
+            if winner is None or loser is None:
+                continue
+            winner.add_win()
+            loser.add_loss()
+            stats[winner.key].add_result(True, loser.name, score.date)
+            stats[loser.key].add_result(False, winner.name, score.date)
+        for user_stats in stats.values():
+            user_stats.invalidate()
+        shards = counters.update_shards_async(deltas).get_result()
+        ndb.put_multi(scores + [user for user in users.values() if user] +
+                      [stats[key] for key in user_keys if users[key]] +
+                      shards)
+        return len(scores)
+
+    @classmethod
+    def query_user(cls, user_key):
+        """Returns a query of the scores the user won or lost, ordered by
+        key so that it can be paged with cursors"""
+        return cls.query(ndb.OR(cls.winner == user_key,
+                                cls.loser == user_key)).order(cls.key)
+
+
+class UserStats(ndb.Model):
+    """Rollup of a User's Scores, a child of the User so that
+    Score.fold_pending updates it in the same entity group as the User.
+    Served from memcache by get_user_stats."""
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
+    # opponent name -> count
+    wins_by_opponent = ndb.JsonProperty()
+    losses_by_opponent = ndb.JsonProperty()
+    # positive for consecutive wins, negative for consecutive losses
+    current_streak = ndb.IntegerProperty(default=0, indexed=False)
+    longest_win_streak = ndb.IntegerProperty(default=0, indexed=False)
+    # 'YYYY-MM-DD' -> [wins, losses] for the last DAYS_KEPT days played
+    daily = ndb.JsonProperty()
+
+    DAYS_KEPT = 90
+    MEMCACHE_PREFIX = 'user_stats:'
+
+    @classmethod
+    def key_for(cls, user_key):
+        return ndb.Key(cls, 'stats', parent=user_key)
+
+    def add_result(self, won, opponent, day):
+        """Folds one game result into the rollup"""
+        self.wins_by_opponent = self.wins_by_opponent or {}
+        self.losses_by_opponent = self.losses_by_opponent or {}
+        self.daily = self.daily or {}
+        by_opponent = self.wins_by_opponent if won else \
+            self.losses_by_opponent
+        by_opponent[opponent] = by_opponent.get(opponent, 0) + 1
+        day = str(day)
+        counts = self.daily.setdefault(day, [0, 0])
+        if won:
+            self.wins += 1
+            counts[0] += 1
+            self.current_streak = max(self.current_streak, 0) + 1
+            self.longest_win_streak = max(self.longest_win_streak,
+                                          self.current_streak)
+        else:
+            self.losses += 1
+            counts[1] += 1
+            self.current_streak = min(self.current_streak, 0) - 1
+        for old_day in sorted(self.daily)[:-self.DAYS_KEPT]:
+            del self.daily[old_day]
+
+    def invalidate(self):
+        """Drops the cached form once the enclosing transaction commits"""
+        cache_key = self.MEMCACHE_PREFIX + self.key.parent().urlsafe()
+        ndb.get_context().call_on_commit(
+            lambda: memcache.delete(cache_key))
+
+    @classmethod
+    def get_form(cls, user):
+        """Returns the UserStatsForm of a user with the results not yet
+        folded added in. Served from memcache while the user has none."""
+        if any(User.get_pending([user])[user.key]):
+            return cls.get_pending_form(user)
+        cache_key = cls.MEMCACHE_PREFIX + user.key.urlsafe()
+        form = memcache.get(cache_key)
+        if form is None:
+            stats = cls.key_for(user.key).get() or cls()
+            form = stats.to_form(user.name)
+            memcache.set(cache_key, form)
+        return form
+
+    @classmethod
+    def get_pending_form(cls, user):
+        """Returns the UserStatsForm of the rollup with the user's pending
+        Scores added in. The queries are eventually consistent, so the
+        scores are read again by key and the ones folded since are
+        skipped."""
+        won = Score.query(Score.pending == True,
+                          Score.winner == user.key).fetch_async(keys_only=True)
+        lost = Score.query(Score.pending == True,
+                           Score.loser == user.key).fetch_async(keys_only=True)
+        stats_key = cls.key_for(user.key)
+        entities = ndb.get_multi([stats_key] + won.get_result() +
+                                 lost.get_result())
+        stats = entities[0] or cls(key=stats_key)
+        scores = sorted([score for score in entities[1:]
+                         if score and score.pending],
+                        key=lambda score: (score.date, score.key.id()))
+        names = get_user_names([k for score in scores
+                                for k in (score.winner, score.loser)])
+        for score in scores:
+            won = score.winner == user.key
+            opponent = names[score.loser if won else score.winner]
+            stats.add_result(won, opponent, score.date)
+        return stats.to_form(user.name)
+
+    def to_form(self, name):
+        wins_by_opponent = self.wins_by_opponent or {}
+        losses_by_opponent = self.losses_by_opponent or {}
+        opponents = set(wins_by_opponent) | set(losses_by_opponent)
+        return UserStatsForm(
+            name=name,
+            wins=self.wins,
+            losses=self.losses,
+            current_streak=self.current_streak,
+            longest_win_streak=self.longest_win_streak,
+            opponents=[OpponentStatsForm(
+                name=opponent,
+                wins=wins_by_opponent.get(opponent, 0),
+                losses=losses_by_opponent.get(opponent, 0))
+                for opponent in sorted(opponents)],
+            daily=[DailyStatsForm(date=day, wins=wins, losses=losses)
+                   for day, (wins, losses) in
+                   sorted((self.daily or {}).items())])
+
+    @classmethod
+    def rebuild(cls, user):
+        """Recomputes a user's rollup from their full Score history. Pending
+        scores are left for Score.fold_pending to add."""
+        scores = sorted([score for score in Score.query_user(user.key).fetch()
+                         if not score.pending],
+                        key=lambda score: (score.date, score.key.id()))
+        names = get_user_names([k for score in scores
+                                for k in (score.winner, score.loser)])
+        stats = cls(key=cls.key_for(user.key))
+        for score in scores:
+            won = score.winner == user.key
+            opponent = names[score.loser if won else score.winner]
+            stats.add_result(won, opponent, score.date)
+        stats.put()
+        stats.invalidate()
+        return stats
 
 
 class GameForm(messages.Message):
     """GameForm for outbound game state information"""
     urlsafe_key = messages.StringField(1, required=True)
-    player1_word = messages.StringField(2, required=True)
-    player2_word = messages.StringField(3, required=True)
+    # Game fields are left out of not_modified responses
+    player1_word = messages.StringField(2)
+    player2_word = messages.StringField(3)
     player1_letter_guess = messages.StringField(4)
     player2_letter_guess = messages.StringField(5)
     attempts_remaining_player1 = messages.IntegerField(6)
     attempts_remaining_player2 = messages.IntegerField(7)
-    player1 = messages.StringField(8, required=True)
-    player2 = messages.StringField(9, required=True)
-    game_over = messages.BooleanField(10, required=True)
+    player1 = messages.StringField(8)
+    player2 = messages.StringField(9)
+    game_over = messages.BooleanField(10)
     winner = messages.StringField(11)
     player1_word_right = messages.StringField(14)
     player2_word_right = messages.StringField(15)
     message = messages.StringField(13)
+    version = messages.IntegerField(16)
+    not_modified = messages.BooleanField(17)
 
 
 class GameForms(messages.Message):
     """Container for multiple GameForm"""
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class NewGameForm(messages.Message):
-    """Used to create a new game"""
+    """Used to create a new game. With random_words the server picks the
+    words that are left out, of the given difficulty if any."""
     player1 = messages.StringField(1, required=True)
     player2 = messages.StringField(2, required=True)
-    player1_word = messages.StringField(3, required=True)
-    player2_word = messages.StringField(4, required=True)
+    player1_word = messages.StringField(3)
+    player2_word = messages.StringField(4)
+    random_words = messages.BooleanField(5, default=False)
+    difficulty = messages.StringField(6)
+
+
+class NewGameForms(messages.Message):
+    """Used to create many games at once"""
+    items = messages.MessageField(NewGameForm, 1, repeated=True)
 
 
 class MakeMoveForm(messages.Message):
@@ -174,6 +983,54 @@ class MakeMoveForm(messages.Message):
     guess = messages.StringField(2, required=True)
 
 
+class MoveRequestForm(messages.Message):
+    """Used to make a move in one of many games at once"""
+    urlsafe_game_key = messages.StringField(1, required=True)
+    user_name = messages.StringField(2, required=True)
+    guess = messages.StringField(3, required=True)
+
+
+class MoveRequestForms(messages.Message):
+    """Used to make many moves at once"""
+    items = messages.MessageField(MoveRequestForm, 1, repeated=True)
+
+
+class BulkGameResultForm(messages.Message):
+    """Outcome of one item of a bulk request"""
+    index = messages.IntegerField(1, required=True)
+    success = messages.BooleanField(2, required=True)
+    error = messages.StringField(3)
+    game = messages.MessageField(GameForm, 4)
+
+
+class BulkGameResultForms(messages.Message):
+    """Outcomes of a bulk request, in request order"""
+    items = messages.MessageField(BulkGameResultForm, 1, repeated=True)
+
+
+class MoveForm(messages.Message):
+    """MoveForm for one move of a game's history"""
+    move = messages.IntegerField(1, required=True)
+    player = messages.StringField(2, required=True)
+    guess = messages.StringField(3, required=True)
+    correct = messages.BooleanField(4)
+    attempts_remaining = messages.IntegerField(5)
+    date = messages.StringField(6)
+
+
+class MoveForms(messages.Message):
+    """Container for a page of MoveForms"""
+    items = messages.MessageField(MoveForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+
+
+class HintForm(messages.Message):
+    """HintForm for the suggested next guess of a player"""
+    letter = messages.StringField(1)
+    # dictionary words still matching, 0 if the hint is by letter frequency
+    candidates = messages.IntegerField(2)
+
+
 class ScoreForm(messages.Message):
     """ScoreForm for outbound Score information"""
     date = messages.StringField(1, required=True)
@@ -184,6 +1041,7 @@ class ScoreForm(messages.Message):
 class ScoreForms(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -200,6 +1058,39 @@ class UserForm(messages.Message):
     total_games_played = messages.IntegerField(5)
 
 
+class UserRankForm(messages.Message):
+    """UserRankForm for a User's position in the rankings"""
+    name = messages.StringField(1, required=True)
+    game_wins = messages.IntegerField(2)
+    rank = messages.IntegerField(3)
+
+
+class OpponentStatsForm(messages.Message):
+    """Wins and losses of a User against one opponent"""
+    name = messages.StringField(1, required=True)
+    wins = messages.IntegerField(2)
+    losses = messages.IntegerField(3)
+
+
+class DailyStatsForm(messages.Message):
+    """Wins and losses of a User on one day"""
+    date = messages.StringField(1, required=True)
+    wins = messages.IntegerField(2)
+    losses = messages.IntegerField(3)
+
+
+class UserStatsForm(messages.Message):
+    """UserStatsForm for a User's score rollup"""
+    name = messages.StringField(1, required=True)
+    wins = messages.IntegerField(2)
+    losses = messages.IntegerField(3)
+    current_streak = messages.IntegerField(4)
+    longest_win_streak = messages.IntegerField(5)
+    opponents = messages.MessageField(OpponentStatsForm, 6, repeated=True)
+    daily = messages.MessageField(DailyStatsForm, 7, repeated=True)
+
+
 class UserForms(messages.Message):
     """Return multiple UserForms"""
     items = messages.MessageField(UserForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
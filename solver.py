@@ -0,0 +1,94 @@
+"""solver.py - Suggests the next guess of a hangman player from a word list.
+The dictionary is loaded once per instance into NumPy arrays bucketed by word
+length: the letter bits of every position (1 << letter) and the letter set of
+every word. Filtering the candidates by the revealed pattern and the guessed
+letters, and counting the letters of the remaining candidates, are then a few
+vectorized operations per bucket instead of a Python loop over the words."""
+
+import threading
+import numpy
+import dictionary
+
+# English letter frequency order, used when no dictionary word matches
+FREQUENCY_ORDER = 'etaoinshrdlcumwfgypbvkjxqz'
+_ORD_A = ord('a')
+_LETTER_BITS = numpy.left_shift(1, numpy.arange(26, dtype=numpy.int32))
+
+_lock = threading.Lock()
+_buckets = None
+
+
+class _Bucket(object):
+    """The words of one length.
+
+    Attributes:
+        bits: (words, length) array of the letter bit of each position
+        masks: (words,) array of the letter set of each word"""
+
+    def __init__(self, words):
+        codes = numpy.array([[ord(letter) - _ORD_A for letter in word]
+                             for word in words], dtype=numpy.int32)
+        self.bits = numpy.left_shift(1, codes)
+        self.masks = numpy.bitwise_or.reduce(self.bits, axis=1)
+
+
+def load(words=None):
+    """Returns a dict of word length -> _Bucket, built the first time it is
+    needed on this instance from words, by default the words of the game
+    dictionary. Words that are not plain a-z are skipped."""
+    global _buckets
+    if _buckets is None:
+        with _lock:
+            if _buckets is None:
+                by_length = {}
+                for word in words or dictionary.get():
+                    word = word.strip().lower()
+                    if word and all('a' <= letter <= 'z' for letter in word):
+                        by_length.setdefault(len(word), set()).add(word)
+                _buckets = dict((length, _Bucket(sorted(words)))
+                                for length, words in by_length.items())
+    return _buckets
+
+
+def candidates(length, revealed, guessed):
+    """Returns a boolean array over the words of this length that are still
+    possible.
+
+    Args:
+        length: Length of the word being guessed
+        revealed: Dict of position -> letter of the revealed positions
+        guessed: 26-bit mask of the letters guessed so far
+    Returns:
+        The array, or None if the dictionary has no word of this length or
+        the pattern has characters other than a-z."""
+    bucket = load().get(length)
+    if bucket is None or \
+       not all('a' <= letter <= 'z' for letter in revealed.values()):
+        return None
+    expected = numpy.zeros(length, dtype=numpy.int32)
+    for position, letter in revealed.items():
+        expected[position] = 1 << (ord(letter) - _ORD_A)
+    # A guessed letter shows at every position it occupies, so revealed
+    # positions must match and hidden positions hold no guessed letter
+    hidden = expected == 0
+    matches = (bucket.bits == expected) | \
+        (hidden & (bucket.bits & guessed == 0))
+    return matches.all(axis=1)
+
+
+def suggest_guess(length, revealed, guessed):
+    """Returns (letter, candidate count): the unguessed letter found in the
+    most remaining candidate words. Falls back to letter frequency order
+    with a count of 0 when no dictionary word matches."""
+    possible = candidates(length, revealed, guessed)
+    if possible is not None and possible.any():
+        masks = load()[length].masks[possible]
+        counts = (masks[:, numpy.newaxis] & _LETTER_BITS != 0).sum(axis=0)
+        counts[(_LETTER_BITS & guessed) != 0] = -1
+        best = int(counts.argmax())
+        if counts[best] > 0:
+            return chr(_ORD_A + best), int(possible.sum())
+    for letter in FREQUENCY_ORDER:
+        if not guessed & 1 << (ord(letter) - _ORD_A):
+            return letter, 0
+    return None, 0
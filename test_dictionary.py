@@ -0,0 +1,63 @@
+"""test_dictionary.py - Unit tests of the word dictionary in dictionary.py.
+They need no App Engine SDK, run them with
+    python -m unittest test_dictionary"""
+
+import random
+import unittest
+import dictionary
+from dictionary import DIFFICULTIES, Dictionary, build
+
+WORDS = ['apple', 'Zebra', 'cat', 'jazz', 'banana', 'quiz', 'dog',
+         'x-ray', 'it\'s', '', 'cat']
+
+
+class DictionaryTest(unittest.TestCase):
+    def setUp(self):
+        self.words = Dictionary(build(WORDS))
+
+    def test_words_are_sorted_lower_case_and_unique(self):
+        self.assertEqual(list(self.words),
+                         ['apple', 'banana', 'cat', 'dog', 'jazz', 'quiz',
+                          'zebra'])
+        self.assertEqual(len(self.words), 7)
+
+    def test_contains(self):
+        for word in ('apple', 'ZEBRA', 'zebra', 'dog'):
+            self.assertIn(word, self.words)
+        for word in ('ap', 'applesauce', 'x-ray', 'aaa', 'zzz', ''):
+            self.assertNotIn(word, self.words)
+
+    def test_difficulties_split_the_words(self):
+        self.assertEqual(sum(self.words.level_sizes), len(self.words))
+        rand = random.Random(1)
+        easy = set(self.words.random_word('easy', rand) for _ in range(50))
+        hard = set(self.words.random_word('hard', rand) for _ in range(50))
+        self.assertFalse(easy & hard)
+        self.assertTrue(all(dictionary.difficulty_score(easy_word) <=
+                            dictionary.difficulty_score(hard_word)
+                            for easy_word in easy for hard_word in hard))
+
+    def test_random_word_of_any_difficulty(self):
+        rand = random.Random(1)
+        for _ in range(20):
+            self.assertIn(self.words.random_word(rand=rand), self.words)
+
+    def test_random_word_without_words_of_a_difficulty(self):
+        words = Dictionary(build(['cat']))
+        self.assertEqual(words.random_word(DIFFICULTIES[-1]), 'cat')
+        with self.assertRaises(ValueError):
+            words.random_word(DIFFICULTIES[0])
+
+    def test_not_a_dictionary(self):
+        with self.assertRaises(ValueError):
+            Dictionary('\0' * 32)
+
+    def test_bundled_dictionary(self):
+        words = Dictionary.open(dictionary.DICTIONARY_FILE)
+        self.assertTrue(len(words))
+        for difficulty in DIFFICULTIES:
+            self.assertIn(words.random_word(difficulty), words)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+"""test_engine.py - Unit tests of the game rules in engine.py. They need no
+App Engine SDK, run them with
+    python -m unittest test_engine"""
+
+import unittest
+from engine import (MAX_ATTEMPTS, HangmanEngine, InvalidMove, index_word,
+                    letters_mask, mask_letters, revealed_letters,
+                    solution_mask)
+
+
+class IndexTest(unittest.TestCase):
+    def test_index_word_records_every_position(self):
+        index = index_word('Banana')
+        self.assertEqual(index[0], 0b101010)
+        self.assertEqual(index[1], 0b000001)
+        self.assertEqual(index[13], 0b010100)
+        self.assertEqual(solution_mask(index), 0b111111)
+
+    def test_index_word_skips_other_characters(self):
+        self.assertEqual(solution_mask(index_word('a-b')), 0b101)
+
+    def test_letters_mask_round_trip(self):
+        self.assertEqual(mask_letters(letters_mask(['z', 'A', 'c'])),
+                         ['a', 'c', 'z'])
+
+    def test_revealed_letters(self):
+        self.assertEqual(revealed_letters('banana', 0b101010),
+                         ['a', 'a', 'a'])
+
+
+class GuessTest(unittest.TestCase):
+    def setUp(self):
+        # Player 0 guesses 'banana', player 1 guesses 'cat'
+        self.engine = HangmanEngine.new('cat', 'banana')
+
+    def test_players_take_turns(self):
+        self.assertEqual(self.engine.next_player, 0)
+        self.engine.guess(0, 'x')
+        self.assertEqual(self.engine.next_player, 1)
+        self.engine.guess(1, 'x')
+        self.assertEqual(self.engine.next_player, 0)
+
+    def test_guess_out_of_turn(self):
+        with self.assertRaisesRegexp(InvalidMove, 'Not your turn yet!'):
+            self.engine.guess(1, 'c')
+        self.engine.guess(0, 'x')
+        with self.assertRaisesRegexp(InvalidMove, 'Not your turn yet!'):
+            self.engine.guess(0, 'y')
+        self.assertEqual(self.engine.attempts, [MAX_ATTEMPTS - 1,
+                                                MAX_ATTEMPTS])
+
+    def test_every_guess_costs_an_attempt(self):
+        self.assertTrue(self.engine.guess(0, 'a'))
+        self.assertFalse(self.engine.guess(1, 'x'))
+        self.assertEqual(self.engine.attempts, [MAX_ATTEMPTS - 1,
+                                                MAX_ATTEMPTS - 1])
+
+    def test_letter_in_several_positions(self):
+        self.assertTrue(self.engine.guess(0, 'a'))
+        self.assertEqual(self.engine.revealed[0], 0b101010)
+        self.assertTrue(self.engine.guess(1, 'A'))
+        self.assertEqual(self.engine.revealed[1], 0b010)
+
+    def test_duplicate_guess(self):
+        self.engine.guess(0, 'a')
+        self.engine.guess(1, 'x')
+        with self.assertRaisesRegexp(InvalidMove, 'already guessed'):
+            self.engine.guess(0, 'A')
+        self.assertEqual(self.engine.attempts[0], MAX_ATTEMPTS - 1)
+        self.assertEqual(self.engine.next_player, 0)
+
+    def test_same_letter_for_both_players(self):
+        self.engine.guess(0, 'x')
+        self.engine.guess(1, 'x')
+        self.assertEqual(self.engine.guessed, [letters_mask('x')] * 2)
+
+    def test_guess_must_be_a_letter(self):
+        with self.assertRaisesRegexp(InvalidMove, 'only 1 character'):
+            self.engine.guess(0, '1')
+        self.assertEqual(self.engine.attempts[0], MAX_ATTEMPTS)
+
+
+class EndTest(unittest.TestCase):
+    def test_other_player_continues_after_running_out(self):
+        engine = HangmanEngine([index_word('cat'), index_word('banana')],
+                               attempts=(1, 3))
+        engine.guess(0, 'x')
+        self.assertEqual(engine.attempts[0], 0)
+        self.assertEqual(engine.next_player, 1)
+        engine.guess(1, 'x')
+        self.assertEqual(engine.next_player, 1)
+        engine.guess(1, 'y')
+        with self.assertRaisesRegexp(InvalidMove, '0 attempts'):
+            engine.guess(0, 'b')
+        self.assertFalse(engine.tie())
+
+    def test_tie_once_both_run_out(self):
+        engine = HangmanEngine([index_word('cat'), index_word('banana')],
+                               attempts=(1, 1))
+        engine.guess(0, 'x')
+        self.assertFalse(engine.tie())
+        engine.guess(1, 'x')
+        self.assertTrue(engine.tie())
+        self.assertIsNone(engine.winner())
+        with self.assertRaisesRegexp(InvalidMove, '0 attempts'):
+            engine.guess(1, 'y')
+
+    def test_solving_wins(self):
+        engine = HangmanEngine.new('cat', 'ab')
+        engine.guess(0, 'a')
+        self.assertIsNone(engine.winner())
+        engine.guess(1, 'x')
+        engine.guess(0, 'b')
+        self.assertTrue(engine.solved(0))
+        self.assertEqual(engine.winner(), 0)
+
+    def test_win_on_last_attempt(self):
+        engine = HangmanEngine([index_word('cat'), index_word('a')],
+                               attempts=(1, 0))
+        self.assertTrue(engine.guess(0, 'a'))
+        self.assertEqual(engine.winner(), 0)
+
+    def test_first_player_wins_when_both_solved(self):
+        words = [index_word('cat'), index_word('ab')]
+        engine = HangmanEngine(words, revealed=(0b11, 0b111))
+        self.assertTrue(engine.solved(0))
+        self.assertTrue(engine.solved(1))
+        self.assertEqual(engine.winner(), 0)
+
+    def test_second_player_wins(self):
+        engine = HangmanEngine.new('a', 'banana')
+        engine.guess(0, 'x')
+        engine.guess(1, 'a')
+        self.assertEqual(engine.winner(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
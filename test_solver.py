@@ -0,0 +1,66 @@
+"""test_solver.py - Unit tests of the guess suggestions in solver.py. They
+need NumPy but no App Engine SDK, run them with
+    python -m unittest test_solver"""
+
+import unittest
+import solver
+from engine import letters_mask
+
+WORDS = ['cat', 'cot', 'cut', 'dog', 'bat', 'Tab', 'x-y', 'apple']
+
+
+class SolverTest(unittest.TestCase):
+    def setUp(self):
+        solver._buckets = None
+        solver.load(WORDS)
+
+    def tearDown(self):
+        solver._buckets = None
+
+    def matches(self, length, revealed, guessed):
+        possible = solver.candidates(length, revealed, guessed)
+        words = sorted(set(word.lower() for word in WORDS
+                           if len(word) == length and word.isalpha()))
+        return [word for word, match in zip(words, possible) if match]
+
+    def test_load_buckets_plain_words_by_length(self):
+        self.assertEqual(sorted(solver._buckets), [3, 5])
+        self.assertEqual(len(solver._buckets[3].masks), 6)
+
+    def test_revealed_letters_must_match(self):
+        self.assertEqual(self.matches(3, {0: 'c', 2: 't'}, letters_mask('ct')),
+                         ['cat', 'cot', 'cut'])
+
+    def test_hidden_positions_hold_no_guessed_letter(self):
+        # 't' was guessed and shows only at the end
+        self.assertEqual(self.matches(3, {2: 't'}, letters_mask('t')),
+                         ['bat', 'cat', 'cot', 'cut'])
+        # A wrong guess rules out the words that contain it
+        self.assertEqual(self.matches(3, {2: 't'}, letters_mask('tc')),
+                         ['bat'])
+
+    def test_unknown_length_or_pattern(self):
+        self.assertIsNone(solver.candidates(4, {}, 0))
+        self.assertIsNone(solver.candidates(3, {0: '-'}, 0))
+
+    def test_suggests_the_most_common_letter(self):
+        self.assertEqual(solver.suggest_guess(3, {0: 'c', 2: 't'},
+                                              letters_mask('ct')),
+                         ('a', 3))
+
+    def test_never_suggests_a_guessed_letter(self):
+        letter, count = solver.suggest_guess(3, {}, letters_mask('tabc'))
+        self.assertNotIn(letter, 'tabc')
+
+    def test_falls_back_to_letter_frequency(self):
+        self.assertEqual(solver.suggest_guess(4, {}, 0), ('e', 0))
+        self.assertEqual(solver.suggest_guess(3, {0: 'z'}, letters_mask('ze')),
+                         ('t', 0))
+
+    def test_every_letter_guessed(self):
+        self.assertEqual(solver.suggest_guess(3, {}, (1 << 26) - 1),
+                         (None, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
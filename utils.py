@@ -2,22 +2,24 @@
 
 import logging
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
 import endpoints
 
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
-def get_by_urlsafe(urlsafe, model):
-    """Returns an ndb.Model entity that the urlsafe key points to. Checks
-        that the type of entity returned is of the correct kind. Raises an
-        error if the key String is malformed or the entity is of the incorrect
-        kind
+
+def get_key_by_urlsafe(urlsafe, model):
+    """Returns the ndb.Key that the urlsafe string encodes without fetching
+        the entity.
     Args:
         urlsafe: A urlsafe key string
         model: The expected entity kind
     Returns:
-        The entity that the urlsafe Key string points to or None if no entity
-        exists.
+        The ndb.Key of the expected kind.
     Raises:
-        ValueError:"""
+        endpoints.BadRequestException: If the key string is malformed
+        ValueError: If the key is of the incorrect kind"""
     try:
         key = ndb.Key(urlsafe=urlsafe)
     except TypeError:
@@ -28,9 +30,67 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
-    if not entity:
-        return None
-    if not isinstance(entity, model):
+    if key.kind() != model._get_kind():
         raise ValueError('Incorrect Kind')
-    return entity
+    return key
+
+
+def get_by_urlsafe(urlsafe, model):
+    """Returns an ndb.Model entity that the urlsafe key points to. Checks
+        that the type of entity returned is of the correct kind. Raises an
+        error if the key String is malformed or the entity is of the incorrect
+        kind
+    Args:
+        urlsafe: A urlsafe key string
+        model: The expected entity kind
+    Returns:
+        The entity that the urlsafe Key string points to or None if no entity
+        exists.
+    Raises:
+        ValueError:"""
+    return get_by_urlsafe_async(urlsafe, model).get_result()
+
+
+@ndb.tasklet
+def get_by_urlsafe_async(urlsafe, model):
+    """Returns a future for get_by_urlsafe"""
+    key = get_key_by_urlsafe(urlsafe, model)
+    entity = yield key.get_async()
+    if entity is None and key.kind() == 'User' and \
+       isinstance(key.id(), (int, long)):
+        # Users are keyed by name now, keys issued before the migration
+        # resolve through the numeric id the migrated entity keeps.
+        entity = yield model.query(model.legacy_id == key.id()).get_async()
+    raise ndb.Return(entity)
+
+
+def fetch_page(query, page_size=None, cursor=None, **kwargs):
+    """Fetches one page of a query so that listings are built from a bounded
+        number of entities instead of the whole kind.
+    Args:
+        query: The ndb.Query to page through
+        page_size: Requested number of results, clamped to 1 to
+            MAX_PAGE_SIZE
+        cursor: A urlsafe cursor string returned by a previous page
+        kwargs: Extra options passed to fetch_page (e.g. projection)
+    Returns:
+        A tuple (results, next_cursor) where next_cursor is a urlsafe string
+        or None when there are no more results.
+    Raises:
+        endpoints.BadRequestException: If the cursor string is malformed"""
+    return fetch_page_async(query, page_size, cursor, **kwargs).get_result()
+
+
+@ndb.tasklet
+def fetch_page_async(query, page_size=None, cursor=None, **kwargs):
+    """Returns a future for fetch_page"""
+    page_size = max(1, min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=start_cursor, **kwargs)
+    if more and next_cursor:
+        raise ndb.Return((results, next_cursor.urlsafe()))
+    raise ndb.Return((results, None))